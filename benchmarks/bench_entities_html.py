@@ -0,0 +1,103 @@
+"""
+Бенчмарк рендера entities -> HTML на постах максимальной длины (4096 символов).
+
+    python benchmarks/bench_entities_html.py
+
+Сравнивает utils.entities_html.entities_to_html со старой реализацией
+_convert_to_html_with_emoji (пересборка UTF-16 строки на каждый custom_emoji,
+остальные entities терялись) и с aiogram html_decoration.unparse.
+"""
+from __future__ import annotations
+
+import json
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiogram.types import MessageEntity  # noqa: E402
+from aiogram.utils.text_decorations import html_decoration  # noqa: E402
+
+from utils.entities_html import entities_to_html  # noqa: E402
+
+POST_LENGTH = 4096
+ALPHABET = "абвгдеёжзийклмнопрстуфхцчшщыэюя abcdefghijklmnopqrstuvwxyz<>&,.!?\n"
+EMOJI = "😀🔥✅👍🎉"
+STYLE_TYPES = ("bold", "italic", "underline", "strikethrough", "spoiler", "code")
+
+
+def legacy_convert(text: str, entities_json: str | None) -> tuple[str, str | None]:
+    """Старая реализация: O(n·k), только custom_emoji."""
+    if not text or not entities_json:
+        return text, None
+    entities = json.loads(entities_json)
+    custom_emojis = [e for e in entities if e.get("type") == "custom_emoji"]
+    if not custom_emojis:
+        return text, None
+    custom_emojis.sort(key=lambda e: e["offset"], reverse=True)
+    text_utf16 = text.encode("utf-16-le")
+    for e in custom_emojis:
+        start_bytes = e["offset"] * 2
+        end_bytes = (e["offset"] + e["length"]) * 2
+        original_emoji = text_utf16[start_bytes:end_bytes].decode("utf-16-le")
+        html_tag = f'<tg-emoji emoji-id="{e["custom_emoji_id"]}">{original_emoji}</tg-emoji>'.encode("utf-16-le")
+        text_utf16 = text_utf16[:start_bytes] + html_tag + text_utf16[end_bytes:]
+    return text_utf16.decode("utf-16-le"), "HTML"
+
+
+def make_post(emoji_every: int, styles: int, rnd: random.Random) -> tuple[str, str]:
+    """Пост на POST_LENGTH символов: custom emoji каждые emoji_every символов + styles стилевых entities."""
+    chars: list[str] = []
+    entities: list[dict] = []
+    pos16 = 0
+    while len(chars) < POST_LENGTH:
+        if emoji_every and len(chars) % emoji_every == 0:
+            ch = rnd.choice(EMOJI)
+            entities.append({
+                "type": "custom_emoji", "offset": pos16, "length": 2,
+                "custom_emoji_id": str(rnd.randint(10 ** 18, 10 ** 19)),
+            })
+        else:
+            ch = rnd.choice(ALPHABET)
+        chars.append(ch)
+        pos16 += 2 if ord(ch) > 0xFFFF else 1
+
+    # стилевые entities не должны резать суррогатные пары пополам — берём границы символов
+    bounds = [0]
+    for ch in chars:
+        bounds.append(bounds[-1] + (2 if ord(ch) > 0xFFFF else 1))
+    for _ in range(styles):
+        a, b = sorted(rnd.sample(bounds, 2))
+        if b > a:
+            entities.append({"type": rnd.choice(STYLE_TYPES), "offset": a, "length": b - a})
+    return "".join(chars), json.dumps(entities)
+
+
+def bench(name: str, fn, number: int) -> float:
+    per_call = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"  {name:<28} {per_call * 1e6:10.1f} µs")
+    return per_call
+
+
+def main() -> None:
+    rnd = random.Random(42)
+    cases = {
+        "plain text": make_post(0, 0, rnd),
+        "custom emoji every 40 chars": make_post(40, 0, rnd),
+        "custom emoji every 4 chars": make_post(4, 0, rnd),
+        "emoji/4 + 200 styles": make_post(4, 200, rnd),
+    }
+    for title, (text, entities_json) in cases.items():
+        entities = json.loads(entities_json)
+        aiogram_entities = [MessageEntity(**e) for e in entities]
+        print(f"{title}: {len(text)} chars, {len(entities)} entities")
+        legacy = bench("legacy (emoji only)", lambda: legacy_convert(text, entities_json), 20)
+        new = bench("entities_to_html", lambda: entities_to_html(text, entities_json), 20)
+        bench("aiogram unparse", lambda: html_decoration.unparse(text, aiogram_entities), 20)
+        print(f"  speedup vs legacy: x{legacy / new:.1f}\n")
+
+
+if __name__ == "__main__":
+    main()
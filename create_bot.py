@@ -5,6 +5,8 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 import logging
 
+from middlewares.rate_limit import RATE_LIMITER, RateLimitMiddleware
+
 
 logging.basicConfig(level=logging.INFO)
 
@@ -13,5 +15,6 @@ load_dotenv(find_dotenv())
 
 bot = Bot(token=os.getenv('TOKEN'), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 bot.my_admins_list = []
+bot.session.middleware(RateLimitMiddleware(RATE_LIMITER))
 
 dp = Dispatcher()
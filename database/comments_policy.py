@@ -0,0 +1,122 @@
+"""
+Кэш политики комментариев для comments_guard.
+
+Обработчик комментариев видит каждое сообщение каждого чата обсуждения, поэтому
+ответы на вопросы «к какому каналу привязан чат», «к какому посту относится ветка»
+и «разрешены ли у поста комментарии» держим в памяти процесса:
+- linked_chat_id -> channel_id;
+- (chat_id, message_id) -> post_id (корень обсуждения / сообщение в канале);
+- post_id -> comments_enabled;
+- множество чатов обсуждения, где есть хоть один пост с выключенными комментариями
+  (CommentsPrefilterMiddleware отбрасывает сообщения остальных чатов до открытия сессии).
+
+Изменения (переключение comments_enabled, отправка поста, смена linked_chat_id)
+сбрасывают кэш после COMMIT — см. signal_comments_policy_changed().
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Iterable
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from database.models import Channel, Post, PostTarget, TargetState
+from utils.ttl_cache import TTLCache
+
+_SESSION_KEY = "comments_policy_posts"
+
+POLICY_TTL = 300.0
+BLOCKED_CHATS_TTL = 60.0
+POLICY_MAXSIZE = 50_000
+
+
+class CommentsPolicy:
+    def __init__(
+            self,
+            *,
+            ttl: float = POLICY_TTL,
+            blocked_chats_ttl: float = BLOCKED_CHATS_TTL,
+            maxsize: int = POLICY_MAXSIZE,
+    ) -> None:
+        self.channel_by_chat: TTLCache[int, int | None] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.post_by_message: TTLCache[tuple[int, int], int | None] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.comments_enabled: TTLCache[int, bool] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.blocked_chats_ttl = blocked_chats_ttl
+        self._blocked_chats: frozenset[int] | None = None
+        self._blocked_chats_at = 0.0
+        self._invalidated_at = 0.0
+        self._blocked_chats_lock = asyncio.Lock()
+
+    async def blocked_chats(self, session_pool: async_sessionmaker[AsyncSession]) -> frozenset[int]:
+        """Чаты обсуждения, где у отправленных постов выключены комментарии."""
+        if self._blocked_chats_fresh():
+            return self._blocked_chats
+        async with self._blocked_chats_lock:
+            # пока ждали блокировку, другой запрос мог уже перечитать
+            if not self._blocked_chats_fresh():
+                loaded_at = time.monotonic()
+                async with session_pool() as session:
+                    chats = await _load_blocked_chats(session)
+                self._blocked_chats = frozenset(chats)
+                self._blocked_chats_at = loaded_at
+        return self._blocked_chats
+
+    def _blocked_chats_fresh(self) -> bool:
+        # загрузка, начатая до сброса, могла прочитать старое состояние
+        return (
+            self._blocked_chats is not None
+            and self._blocked_chats_at > self._invalidated_at
+            and time.monotonic() - self._blocked_chats_at < self.blocked_chats_ttl
+        )
+
+    def invalidate_posts(self, post_ids: Iterable[int]) -> None:
+        for post_id in post_ids:
+            self.comments_enabled.pop(post_id)
+        self._invalidated_at = time.monotonic()
+
+    def invalidate_chats(self) -> None:
+        self.channel_by_chat.clear()
+        self._invalidated_at = time.monotonic()
+
+
+async def _load_blocked_chats(session: AsyncSession) -> list[int]:
+    q = (
+        select(Channel.linked_chat_id)
+        .join(PostTarget, PostTarget.channel_id == Channel.id)
+        .join(Post, Post.id == PostTarget.post_id)
+        .where(Channel.linked_chat_id.is_not(None))
+        .where(PostTarget.state == TargetState.sent)
+        .where(Post.comments_enabled == False)
+        .distinct()
+    )
+    res = await session.execute(q)
+    return list(res.scalars().all())
+
+
+COMMENTS_POLICY = CommentsPolicy()
+
+
+def signal_comments_policy_changed(session: AsyncSession | Session, post_id: int | None = None) -> None:
+    """
+    Политика комментариев поста (или привязка чатов, если post_id=None) изменилась;
+    кэш сбросится после COMMIT.
+    """
+    session.info.setdefault(_SESSION_KEY, set()).add(post_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_comments_policy_changes(session: Session) -> None:
+    post_ids = session.info.pop(_SESSION_KEY, None)
+    if not post_ids:
+        return
+    if None in post_ids:
+        COMMENTS_POLICY.invalidate_chats()
+    COMMENTS_POLICY.invalidate_posts(p for p in post_ids if p is not None)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_comments_policy_changes(session: Session) -> None:
+    session.info.pop(_SESSION_KEY, None)
@@ -0,0 +1,141 @@
+"""
+Дедлайны планировщика (publish_at / auto_delete_at) в памяти процесса.
+
+Планировщик спит ровно до ближайшего дедлайна, а ORM-функции, которые
+планируют/переносят публикацию, будят его через signal_deadline().
+Сигнал доставляется только после COMMIT — до этого планировщик всё равно
+не увидит изменения в БД:
+- в своём процессе — сразу в SCHEDULER_DEADLINES;
+- в остальных процессах — через Postgres NOTIFY на канал DEADLINES_CHANNEL
+  (NOTIFY транзакционный, уходит вместе с COMMIT), см. listen_deadlines().
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+from datetime import datetime
+from typing import Iterable
+
+from sqlalchemy import event, select, func
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+_SESSION_KEY = "scheduler_deadlines"
+
+DEADLINES_CHANNEL = "posted_scheduler"
+
+
+class SchedulerDeadlines:
+    """Min-куча ближайших дедлайнов + событие пробуждения планировщика."""
+
+    def __init__(self) -> None:
+        self._heap: list[datetime] = []
+        self._wakeup = asyncio.Event()
+
+    def push(self, when: datetime | None) -> None:
+        if when is None:
+            return
+        is_earliest = not self._heap or when < self._heap[0]
+        heapq.heappush(self._heap, when)
+        if is_earliest:
+            self._wakeup.set()
+
+    def extend(self, deadlines: Iterable[datetime | None]) -> None:
+        for when in deadlines:
+            self.push(when)
+
+    def clear(self) -> None:
+        self._heap.clear()
+
+    def next_deadline(self) -> datetime | None:
+        return self._heap[0] if self._heap else None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def sleep(self, max_idle: float) -> None:
+        """
+        Спит до ближайшего дедлайна (но не дольше max_idle).
+        Если пришёл более ранний дедлайн — пересчитывает время сна.
+        """
+        loop = asyncio.get_running_loop()
+        idle_until = loop.time() + max_idle
+        while True:
+            self._wakeup.clear()
+            delay = idle_until - loop.time()
+            top = self.next_deadline()
+            if top is not None:
+                delay = min(delay, (top - datetime.utcnow()).total_seconds())
+            if delay <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                return
+
+
+SCHEDULER_DEADLINES = SchedulerDeadlines()
+
+
+def signal_deadline(session: AsyncSession | Session, when: datetime | None) -> None:
+    """Запомнить дедлайн в сессии; планировщик узнает о нём после COMMIT."""
+    if when is None:
+        return
+    session.info.setdefault(_SESSION_KEY, []).append(when)
+
+
+@event.listens_for(Session, "before_commit")
+def _notify_deadlines(session: Session) -> None:
+    deadlines = session.info.get(_SESSION_KEY)
+    if not deadlines or session.get_bind().dialect.name != "postgresql":
+        return
+    # Остальным процессам достаточно самого раннего дедлайна:
+    # после прохода планировщик всё равно перечитывает кучу из БД.
+    session.execute(select(func.pg_notify(DEADLINES_CHANNEL, min(deadlines).isoformat())))
+
+
+@event.listens_for(Session, "after_commit")
+def _deliver_deadlines(session: Session) -> None:
+    SCHEDULER_DEADLINES.extend(session.info.pop(_SESSION_KEY, ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_deadlines(session: Session) -> None:
+    session.info.pop(_SESSION_KEY, None)
+
+
+def _on_deadline_notify(connection, pid, channel, payload) -> None:
+    try:
+        SCHEDULER_DEADLINES.push(datetime.fromisoformat(payload))
+    except (TypeError, ValueError):
+        SCHEDULER_DEADLINES.push(datetime.utcnow())
+
+
+async def listen_deadlines(engine: AsyncEngine, *, reconnect_delay: float = 5.0) -> None:
+    """
+    LISTEN на DEADLINES_CHANNEL на отдельном соединении (asyncpg).
+    Дедлайны из других процессов (бот, соседние планировщики) сразу попадают в кучу,
+    поэтому «Выложить сразу» отправляется без ожидания очередного прохода.
+    """
+    while True:
+        try:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                pg = raw.driver_connection
+                await pg.add_listener(DEADLINES_CHANNEL, _on_deadline_notify)
+                # пока соединения не было, уведомления могли потеряться — внеочередной проход
+                SCHEDULER_DEADLINES.push(datetime.utcnow())
+                try:
+                    while not pg.is_closed():
+                        await asyncio.sleep(reconnect_delay)
+                finally:
+                    if not pg.is_closed():
+                        await pg.remove_listener(DEADLINES_CHANNEL, _on_deadline_notify)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"[deadlines] LISTEN connection lost: {e}")
+        await asyncio.sleep(reconnect_delay)
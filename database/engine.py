@@ -1,4 +1,5 @@
 import os
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from database.models import Base
@@ -8,10 +9,57 @@ engine = create_async_engine(os.getenv('DB_URL'), echo=True)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
+# create_all не добавляет новые колонки в уже существующие таблицы —
+# идемпотентные ALTER'ы для баз, созданных до появления этих колонок.
+SCHEMA_UPGRADES = (
+    "ALTER TABLE post_targets ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(64)",
+    "ALTER TABLE post_targets ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITHOUT TIME ZONE",
+    "ALTER TABLE post_targets ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE post_targets ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITHOUT TIME ZONE",
+    "ALTER TABLE post_targets ADD COLUMN IF NOT EXISTS sent_message_ids JSONB",
+    "ALTER TABLE post_targets ADD COLUMN IF NOT EXISTS keyboard_message_id BIGINT",
+    # posts.text_entities: TEXT (json.dumps) -> JSONB, только если колонка ещё текстовая
+    """
+    DO $$
+    BEGIN
+        IF (SELECT data_type FROM information_schema.columns
+            WHERE table_name = 'posts' AND column_name = 'text_entities') = 'text' THEN
+            ALTER TABLE posts ALTER COLUMN text_entities TYPE JSONB
+                USING NULLIF(text_entities, '')::jsonb;
+        END IF;
+    END $$
+    """,
+    # target_messages для targets, отправленных до появления таблицы (один раз, пока она пуста)
+    """
+    INSERT INTO target_messages (chat_id, message_id, target_id)
+    SELECT src.chat_id, src.message_id, src.target_id
+    FROM (
+        SELECT t.channel_id AS chat_id, m.message_id, t.id AS target_id
+        FROM post_targets t
+        CROSS JOIN LATERAL (
+            SELECT t.sent_message_id AS message_id
+            UNION
+            SELECT jsonb_array_elements_text(COALESCE(t.sent_message_ids, '[]'::jsonb))::bigint
+        ) m
+        WHERE t.sent_message_id IS NOT NULL
+        UNION ALL
+        SELECT c.linked_chat_id, t.discussion_message_id, t.id
+        FROM post_targets t
+        JOIN channels c ON c.id = t.channel_id
+        WHERE t.discussion_message_id IS NOT NULL AND c.linked_chat_id IS NOT NULL
+    ) src
+    WHERE src.message_id IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM target_messages)
+    ON CONFLICT DO NOTHING
+    """,
+)
+
 
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for stmt in SCHEMA_UPGRADES:
+            await conn.execute(text(stmt))
 
 
 async def drop_db():
@@ -0,0 +1,87 @@
+"""
+Кэш скрытых продолжений постов для кнопки «🔒 Читать продолжение».
+
+На вирусном посте кнопку нажимают тысячи раз в минуту, а содержимое скрытой части
+и список каналов поста меняются редко. Поэтому post_id -> HiddenPartView
+(каналы публикации + тексты) читается из БД один раз и живёт в памяти процесса;
+пост без скрытой части кэшируется как None.
+
+Сохранение / удаление скрытой части и отправка поста в новый канал сбрасывают
+запись после COMMIT — см. signal_hidden_part_changed().
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database.models import PostHiddenPart, PostTarget
+from utils.ttl_cache import MISSING, TTLCache
+
+_SESSION_KEY = "hidden_parts_posts"
+
+HIDDEN_PARTS_TTL = 300.0
+HIDDEN_PARTS_MAXSIZE = 10_000
+
+
+@dataclass(frozen=True)
+class HiddenPartView:
+    """Всё, что нужно для ответа на нажатие кнопки скрытого продолжения."""
+    post_id: int
+    channel_ids: tuple[int, ...]
+    button_text: str
+    subscriber_text: str
+    nonsubscriber_text: str | None
+
+
+HIDDEN_PARTS: TTLCache[int, HiddenPartView | None] = TTLCache(
+    maxsize=HIDDEN_PARTS_MAXSIZE, ttl=HIDDEN_PARTS_TTL,
+)
+
+
+async def get_hidden_part_view(session: AsyncSession, post_id: int) -> HiddenPartView | None:
+    """Скрытая часть поста с каналами публикации; None — скрытой части (или каналов) нет."""
+    view = HIDDEN_PARTS.get(post_id, MISSING)
+    if view is MISSING:
+        view = await _load_hidden_part_view(session, post_id)
+        HIDDEN_PARTS.set(post_id, view)
+    return view
+
+
+async def _load_hidden_part_view(session: AsyncSession, post_id: int) -> HiddenPartView | None:
+    hidden = await session.get(PostHiddenPart, post_id)
+    if hidden is None:
+        return None
+    res = await session.execute(
+        select(PostTarget.channel_id)
+        .where(PostTarget.post_id == post_id)
+        .order_by(PostTarget.id)
+    )
+    channel_ids = tuple(dict.fromkeys(res.scalars().all()))
+    if not channel_ids:
+        return None
+    return HiddenPartView(
+        post_id=post_id,
+        channel_ids=channel_ids,
+        button_text=hidden.button_text,
+        subscriber_text=hidden.subscriber_text,
+        nonsubscriber_text=hidden.nonsubscriber_text,
+    )
+
+
+def signal_hidden_part_changed(session: AsyncSession | Session, post_id: int) -> None:
+    """Скрытая часть или каналы поста изменились; кэш сбросится после COMMIT."""
+    session.info.setdefault(_SESSION_KEY, set()).add(post_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_hidden_part_changes(session: Session) -> None:
+    for post_id in session.info.pop(_SESSION_KEY, ()):
+        HIDDEN_PARTS.pop(post_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_hidden_part_changes(session: Session) -> None:
+    session.info.pop(_SESSION_KEY, None)
@@ -219,7 +219,8 @@ class Post(Base):
 
     # Content
     text: Mapped[str | None] = mapped_column(Text, nullable=True)
-    text_entities: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # entities как список dict без None-полей (utils.entities_html.dump_entities)
+    text_entities: Mapped[list[dict] | None] = mapped_column(JSONB, nullable=True)
     # Post settings (from ТЗ "кнопки редактирования")
     silent: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)  # 🔔/🔕
     pinned: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)  # Закрепить
@@ -390,6 +391,10 @@ class PostTarget(Base):
         DateTime(timezone=False), nullable=True
     )
     sent_message_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    # All messages of the publication (album parts + keyboard message), first == sent_message_id
+    sent_message_ids: Mapped[list[int] | None] = mapped_column(JSONB, nullable=True)
+    # Message that carries the inline keyboard (separate message for albums)
+    keyboard_message_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
 
     # For "Изменить пост" - the original message being edited
     edit_origin_message_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
@@ -408,6 +413,15 @@ class PostTarget(Base):
 
     last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
 
+    # Retries of transient publish errors (flood wait, 5xx, network)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    next_attempt_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=False), nullable=True)
+
+    # Scheduler lease: which scheduler process claimed the target and until when.
+    # Expired leases can be re-claimed by any process (crash recovery).
+    lease_owner: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    lease_expires_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=False), nullable=True)
+
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=False), nullable=False, server_default=func.now()
     )
@@ -445,6 +459,30 @@ class PostTarget(Base):
     )
 
 
+# =============================================================================
+# TARGET MESSAGES (message id -> target lookup)
+# =============================================================================
+
+class TargetMessage(Base):
+    """
+    Every Telegram message that belongs to a published target:
+    channel messages (all album parts + keyboard message) and their
+    automatic forwards in the linked discussion group.
+    Comment/edit handlers resolve (chat_id, message_id) -> target with one PK probe.
+    """
+    __tablename__ = "target_messages"
+
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    message_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    target_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("post_targets.id", ondelete="CASCADE"), nullable=False
+    )
+
+    __table_args__ = (
+        Index("ix_target_messages_target", "target_id"),
+    )
+
+
 # =============================================================================
 # REPLY TARGET (Ответный пост)
 # =============================================================================
@@ -608,3 +646,20 @@ class ReactionClick(Base):
 
     # Relationships
     button: Mapped["PostReactionButton"] = relationship(back_populates="clicks")
+
+
+class PostReactionCounterShard(Base):
+    """
+    Слот счётчика кнопки-реакции (shard = user_id % REACTION_COUNTER_SHARDS,
+    см. utils/reaction_aggregator.py).
+    Изменения счётчика пишутся сюда, в разные строки, а не в одну горячую
+    post_reaction_buttons.click_count; периодический rollup переносит сумму
+    слотов в click_count. Итог кнопки = click_count + сумма её слотов.
+    """
+    __tablename__ = "post_reaction_counter_shards"
+
+    button_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("post_reaction_buttons.id", ondelete="CASCADE"), primary_key=True
+    )
+    shard: Mapped[int] = mapped_column(SmallInteger, primary_key=True)
+    delta: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
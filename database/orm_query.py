@@ -19,12 +19,12 @@ ORM Query Layer для Posted Bot
 
 from __future__ import annotations
 
-import json
 from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta
 from typing import Sequence, Iterable
 
-from sqlalchemy import and_, delete, exists, func, select, update, or_
+from sqlalchemy import and_, delete, exists, func, insert, or_, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload, joinedload
 
@@ -32,9 +32,13 @@ from database.models import (
     User, Channel, ChannelAdmin, TgMemberStatus,
     Folder, FolderChannel,
     Post, PostMedia, PostButton, PostHiddenPart, MediaType,
-    PostTarget, TargetState, ReplyTarget, ReplyType,
+    PostTarget, TargetState, TargetMessage, ReplyTarget, ReplyType, PostReactionCounterShard,
     UserState, PostEvent, PostEventType
 )
+from database.comments_policy import signal_comments_policy_changed
+from database.deadlines import signal_deadline
+from database.hidden_parts import signal_hidden_part_changed
+from utils.entities_html import dump_entities
 
 
 # ---------------------------------------------------------------------
@@ -199,6 +203,8 @@ async def orm_upsert_channel(
             linked_chat_id=linked_chat_id,  # <-- ДОБАВИТЬ
         )
         session.add(channel)
+    if linked_chat_id is not None:
+        signal_comments_policy_changed(session)
 
 
 async def orm_add_channel_admin(
@@ -550,7 +556,7 @@ async def orm_create_post_with_targets(
 
 
 async def orm_get_post_full(session: AsyncSession, *, post_id: int) -> Post:
-    """Полная загрузка: media/buttons/hidden_part/targets."""
+    """Полная загрузка: media/buttons/hidden_part/reaction_buttons/targets."""
     q = (
         select(Post)
         .where(Post.id == post_id)
@@ -559,6 +565,7 @@ async def orm_get_post_full(session: AsyncSession, *, post_id: int) -> Post:
             selectinload(Post.buttons),
             selectinload(Post.targets),
             selectinload(Post.hidden_part),
+            selectinload(Post.reaction_buttons),
         )
     )
     res = await session.execute(q)
@@ -568,6 +575,16 @@ async def orm_get_post_full(session: AsyncSession, *, post_id: int) -> Post:
     return post
 
 
+async def _bump_post_version(session: AsyncSession, post_id: int) -> None:
+    """
+    Любое изменение содержимого поста (текст, медиа, кнопки, скрытая часть) меняет version —
+    закэшированный рендер (post_id, version) перестаёт использоваться.
+    """
+    await session.execute(
+        update(Post).where(Post.id == post_id).values(version=Post.version + 1)
+    )
+
+
 async def orm_update_post_text(session: AsyncSession, *, post_id: int, text: str | None) -> None:
     post = await session.get(Post, post_id)
     if not post:
@@ -600,6 +617,7 @@ async def orm_set_post_flags(
         post.protected = protected
     if comments_enabled is not None:
         post.comments_enabled = comments_enabled
+        signal_comments_policy_changed(session, post_id)
     if reactions_enabled is not None:
         post.reactions_enabled = reactions_enabled
     if is_repost is not None:
@@ -633,6 +651,8 @@ async def orm_delete_post(
             await orm_require_channel_access(session, user_id=actor_user_id, channel_id=channel_id)
 
     await session.delete(post)
+    # скрытая часть удаляется каскадом — кнопка в канале больше не должна её показывать
+    signal_hidden_part_changed(session, post_id)
     await session.flush()
 
 
@@ -651,6 +671,7 @@ async def orm_replace_post_buttons(
     await session.execute(delete(PostButton).where(PostButton.post_id == post_id))
     for row, pos, text, url in buttons:
         session.add(PostButton(post_id=post_id, row=row, position=pos, text=text, url=url))
+    await _bump_post_version(session, post_id)
     await session.flush()
 
 
@@ -660,6 +681,8 @@ async def orm_set_hidden_part(session: AsyncSession, *, post_id: int, text: str
     if not text:
         if hp:
             await session.execute(delete(PostHiddenPart).where(PostHiddenPart.post_id == post_id))
+            await _bump_post_version(session, post_id)
+            signal_hidden_part_changed(session, post_id)
             await session.flush()
         return
 
@@ -667,6 +690,8 @@ async def orm_set_hidden_part(session: AsyncSession, *, post_id: int, text: str
         session.add(PostHiddenPart(post_id=post_id, text=text))
     else:
         hp.text = text
+    await _bump_post_version(session, post_id)
+    signal_hidden_part_changed(session, post_id)
     await session.flush()
 
 
@@ -705,6 +730,7 @@ async def orm_add_post_media(
         order_index=order_index,
     )
     session.add(m)
+    await _bump_post_version(session, post_id)
     await session.flush()
     return m
 
@@ -715,11 +741,13 @@ async def orm_delete_post_media(session: AsyncSession, post_id: int):
     await session.execute(
         delete(PostMedia).where(PostMedia.post_id == post_id)
     )
+    await _bump_post_version(session, post_id)
 
 
 async def orm_clear_post_media(session: AsyncSession, *, post_id: int) -> None:
     """ДОБАВЛЕНО: Удалить все медиа поста."""
     await session.execute(delete(PostMedia).where(PostMedia.post_id == post_id))
+    await _bump_post_version(session, post_id)
     await session.flush()
 
 
@@ -754,6 +782,32 @@ async def orm_get_target_full(session: AsyncSession, *, target_id: int) -> PostT
     return t
 
 
+async def orm_get_targets_full(session: AsyncSession, *, target_ids: Sequence[int]) -> list[PostTarget]:
+    """
+    Пакетная версия orm_get_target_full: полные графы всех target за фиксированное число запросов
+    (targets + posts + по одному selectin на каждую коллекцию), независимо от размера батча.
+    Targets одного поста делят один загруженный Post (identity map).
+    Порядок результата совпадает с target_ids; отсутствующие id пропускаются.
+    """
+    if not target_ids:
+        return []
+    post_opt = selectinload(PostTarget.post)
+    q = (
+        select(PostTarget)
+        .where(PostTarget.id.in_(target_ids))
+        .options(
+            post_opt.selectinload(Post.media),
+            post_opt.selectinload(Post.buttons),
+            post_opt.selectinload(Post.hidden_part),
+            post_opt.selectinload(Post.reaction_buttons),
+            selectinload(PostTarget.reply),
+        )
+    )
+    res = await session.execute(q)
+    by_id = {t.id: t for t in res.scalars().all()}
+    return [by_id[tid] for tid in target_ids if tid in by_id]
+
+
 async def orm_schedule_target(
     session: AsyncSession,
     *,
@@ -768,12 +822,15 @@ async def orm_schedule_target(
     t.publish_at = publish_at
     t.state = TargetState.scheduled
     t.last_error = None
+    t.attempts = 0
+    t.next_attempt_at = None
 
     # Пересчитываем auto_delete_at если задан delete_after
     if t.auto_delete_after is not None:
         t.auto_delete_at = publish_at + t.auto_delete_after
 
     await session.flush()
+    signal_deadline(session, publish_at)
 
 
 async def orm_reschedule_target(
@@ -795,12 +852,15 @@ async def orm_reschedule_target(
 
     t.publish_at = new_publish_at
     t.state = TargetState.scheduled
+    t.attempts = 0
+    t.next_attempt_at = None
 
     # Пересчитываем auto_delete_at
     if t.auto_delete_after is not None:
         t.auto_delete_at = new_publish_at + t.auto_delete_after
 
     await session.flush()
+    signal_deadline(session, new_publish_at)
 
 
 async def orm_publish_target_now(
@@ -822,11 +882,14 @@ async def orm_publish_target_now(
     now = datetime.utcnow()
     t.publish_at = now
     t.state = TargetState.queued  # Сразу в очередь
+    t.attempts = 0
+    t.next_attempt_at = None
 
     if t.auto_delete_after is not None:
         t.auto_delete_at = now + t.auto_delete_after
 
     await session.flush()
+    signal_deadline(session, now)
 
 
 async def orm_cancel_target(
@@ -868,6 +931,8 @@ async def orm_set_target_autodelete(
             t.auto_delete_at = None
     t.auto_deleted = False
     await session.flush()
+    if t.state == TargetState.sent:
+        signal_deadline(session, t.auto_delete_at)
 
 
 async def orm_set_target_edit_origin(
@@ -926,6 +991,7 @@ async def orm_copy_target_to_channels(
         created.append(t)
 
     await session.flush()
+    signal_deadline(session, copy_publish_at)
     return created
 
 
@@ -1021,52 +1087,216 @@ async def orm_clear_reply_target(
 # Scheduler: pick queued targets, mark sent/failed, auto-delete
 # ---------------------------------------------------------------------
 
+@dataclass(frozen=True)
+class PickedTarget:
+    """Строка, переведённая scheduled -> queued (без ORM-объекта)."""
+    target_id: int
+    post_id: int
+    channel_id: int
+
+
 async def orm_pick_targets_to_publish(
     session: AsyncSession,
     *,
     limit: int = 50,
     now: datetime | None = None,
-) -> list[PostTarget]:
+) -> list[PickedTarget]:
     """
-    Берем scheduled targets с publish_at <= now и переводим в queued.
+    Переводим scheduled targets с publish_at <= now в queued одним UPDATE ... RETURNING.
+    SKIP LOCKED: строки, которые сейчас переводит другой процесс планировщика, пропускаются.
     """
     if now is None:
         now = datetime.utcnow()
 
-    q = (
-        select(PostTarget)
+    due = (
+        select(PostTarget.id)
         .where(PostTarget.state == TargetState.scheduled)
         .where(PostTarget.publish_at.is_not(None))
         .where(PostTarget.publish_at <= now)
         .order_by(PostTarget.publish_at.asc(), PostTarget.id.asc())
         .limit(limit)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    q = (
+        update(PostTarget)
+        .where(PostTarget.id.in_(due))
+        .values(state=TargetState.queued)
+        .returning(PostTarget.id, PostTarget.post_id, PostTarget.channel_id)
+        .execution_options(synchronize_session=False)
     )
-
     res = await session.execute(q)
-    targets = list(res.scalars().all())
-    for t in targets:
-        t.state = TargetState.queued
-    await session.flush()
+    return [PickedTarget(target_id=r.id, post_id=r.post_id, channel_id=r.channel_id) for r in res]
+
+
+def _lease_is_free(now: datetime):
+    return or_(PostTarget.lease_expires_at.is_(None), PostTarget.lease_expires_at < now)
+
+
+async def orm_claim_targets_to_send(
+    session: AsyncSession,
+    *,
+    owner: str,
+    limit: int = 20,
+    lease_for: timedelta = timedelta(minutes=5),
+    now: datetime | None = None,
+) -> list[PostTarget]:
+    """
+    Захватывает queued targets для отправки: одним UPDATE ... RETURNING ставит lease_owner/lease_expires_at.
+    Несколько процессов планировщика могут работать с одной очередью —
+    строки, залоченные другим процессом (SKIP LOCKED) или с живой арендой, не берутся.
+    """
+    if now is None:
+        now = datetime.utcnow()
+
+    claimable = (
+        select(PostTarget.id)
+        .where(PostTarget.state == TargetState.queued)
+        .where(_lease_is_free(now))
+        .where(or_(PostTarget.next_attempt_at.is_(None), PostTarget.next_attempt_at <= now))
+        .order_by(PostTarget.publish_at.asc().nullsfirst(), PostTarget.id.asc())
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(PostTarget)
+        .where(PostTarget.id.in_(claimable.scalar_subquery()))
+        .values(lease_owner=owner, lease_expires_at=now + lease_for)
+        .returning(PostTarget)
+        .execution_options(synchronize_session=False)
+    )
+    res = await session.scalars(stmt)
+    targets = list(res.all())
+    targets.sort(key=lambda t: (t.publish_at is not None, t.publish_at or now, t.id))
     return targets
 
 
+async def orm_renew_target_lease(
+    session: AsyncSession,
+    *,
+    target_id: int,
+    owner: str,
+    lease_for: timedelta,
+    now: datetime | None = None,
+) -> bool:
+    """
+    Продлевает аренду target перед отправкой. False — аренда уже не наша
+    (истекла и target захватил другой процесс): отправлять нельзя.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    res = await session.execute(
+        update(PostTarget)
+        .where(PostTarget.id == target_id)
+        .where(PostTarget.state == TargetState.queued)
+        .where(PostTarget.lease_owner == owner)
+        .values(lease_expires_at=now + lease_for)
+        .returning(PostTarget.id)
+        .execution_options(synchronize_session=False)
+    )
+    return res.first() is not None
+
+
+async def _get_leased_target(session: AsyncSession, target_id: int, owner: str | None) -> PostTarget | None:
+    """
+    Target для записи результата отправки. С owner — только если аренда всё ещё наша
+    (строка блокируется до конца транзакции), иначе None: результат устарел.
+    """
+    if owner is None:
+        return await orm_get_target(session, target_id=target_id)
+    q = (
+        select(PostTarget)
+        .where(PostTarget.id == target_id)
+        .where(PostTarget.lease_owner == owner)
+        .with_for_update()
+    )
+    return (await session.scalars(q)).first()
+
+
 async def orm_mark_target_sent(
     session: AsyncSession,
     *,
     target_id: int,
     sent_message_id: int,
+    sent_message_ids: Sequence[int] | None = None,
+    keyboard_message_id: int | None = None,
     sent_at: datetime | None = None,
-) -> None:
-    t = await orm_get_target(session, target_id=target_id)
+    owner: str | None = None,
+) -> bool:
+    """
+    sent_message_ids — все сообщения публикации (альбом + сообщение с кнопками),
+    keyboard_message_id — сообщение с inline-клавиатурой (если есть).
+    owner — записать, только если аренда target всё ещё у этого процесса; False — не наша.
+    """
+    t = await _get_leased_target(session, target_id, owner)
+    if t is None:
+        return False
     t.state = TargetState.sent
     t.sent_message_id = sent_message_id
+    t.sent_message_ids = list(sent_message_ids) if sent_message_ids else [sent_message_id]
+    t.keyboard_message_id = keyboard_message_id
     t.sent_at = sent_at or datetime.utcnow()
     t.last_error = None
+    t.next_attempt_at = None
+    t.lease_owner = None
+    t.lease_expires_at = None
 
     # Рассчитываем auto_delete_at от времени отправки
     if t.auto_delete_after is not None and t.auto_delete_at is None:
         t.auto_delete_at = t.sent_at + t.auto_delete_after
     await session.flush()
+    await orm_map_target_messages(
+        session, target_id=t.id, chat_id=t.channel_id, message_ids=t.sent_message_ids,
+    )
+    # новый пост с выключенными комментариями добавляет чат обсуждения в фильтр
+    comments_enabled = await session.scalar(select(Post.comments_enabled).where(Post.id == t.post_id))
+    if comments_enabled is False:
+        signal_comments_policy_changed(session, t.post_id)
+    # канал мог добавиться к списку, где проверяется подписка для скрытой части
+    signal_hidden_part_changed(session, t.post_id)
+    signal_deadline(session, t.auto_delete_at)
+    return True
+
+
+async def orm_map_target_messages(
+    session: AsyncSession,
+    *,
+    target_id: int,
+    chat_id: int,
+    message_ids: Iterable[int],
+) -> None:
+    """Запомнить, что сообщения (chat_id, message_id) принадлежат target (для поиска по message id)."""
+    rows = [{"chat_id": chat_id, "message_id": mid, "target_id": target_id} for mid in set(message_ids)]
+    if not rows:
+        return
+    stmt = pg_insert(TargetMessage).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TargetMessage.chat_id, TargetMessage.message_id],
+        set_={"target_id": stmt.excluded.target_id},
+    )
+    await session.execute(stmt)
+
+
+async def orm_find_target_by_message(
+    session: AsyncSession,
+    *,
+    chat_id: int,
+    message_id: int,
+    options: Sequence = (),
+) -> PostTarget | None:
+    """
+    Target, которому принадлежит сообщение: сообщение в канале (любая часть альбома,
+    сообщение с кнопками) или автопересылка в чате обсуждения. Поиск по PK target_messages.
+    """
+    q = (
+        select(PostTarget)
+        .join(TargetMessage, TargetMessage.target_id == PostTarget.id)
+        .where(TargetMessage.chat_id == chat_id)
+        .where(TargetMessage.message_id == message_id)
+        .options(*options)
+    )
+    res = await session.execute(q)
+    return res.unique().scalars().first()
 
 
 async def orm_mark_target_failed(
@@ -1074,11 +1304,67 @@ async def orm_mark_target_failed(
     *,
     target_id: int,
     error: str,
-) -> None:
-    t = await orm_get_target(session, target_id=target_id)
+    owner: str | None = None,
+) -> bool:
+    t = await _get_leased_target(session, target_id, owner)
+    if t is None:
+        return False
     t.state = TargetState.failed
     t.last_error = (error or "")[:4000]
+    t.lease_owner = None
+    t.lease_expires_at = None
     await session.flush()
+    return True
+
+
+async def orm_mark_target_retry(
+    session: AsyncSession,
+    *,
+    target_id: int,
+    error: str,
+    next_attempt_at: datetime,
+    owner: str | None = None,
+) -> bool:
+    """
+    Временная ошибка отправки (flood wait, 5xx, сеть): target остаётся queued
+    и будет снова захвачен планировщиком не раньше next_attempt_at.
+    """
+    t = await _get_leased_target(session, target_id, owner)
+    if t is None:
+        return False
+    t.state = TargetState.queued
+    t.attempts = (t.attempts or 0) + 1
+    t.next_attempt_at = next_attempt_at
+    t.last_error = (error or "")[:4000]
+    t.lease_owner = None
+    t.lease_expires_at = None
+    await session.flush()
+    signal_deadline(session, next_attempt_at)
+    return True
+
+
+async def orm_defer_targets(
+    session: AsyncSession,
+    *,
+    target_ids: Sequence[int],
+    owner: str,
+    next_attempt_at: datetime,
+) -> None:
+    """
+    Отложить targets, до которых очередь канала не дошла (канал упёрся во временную ошибку):
+    только next_attempt_at и снятие аренды — попытка не засчитывается, last_error не меняется.
+    """
+    if not target_ids:
+        return
+    await session.execute(
+        update(PostTarget)
+        .where(PostTarget.id.in_(list(target_ids)))
+        .where(PostTarget.state == TargetState.queued)
+        .where(PostTarget.lease_owner == owner)
+        .values(next_attempt_at=next_attempt_at, lease_owner=None, lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    signal_deadline(session, next_attempt_at)
 
 
 async def orm_pick_targets_to_autodelete(
@@ -1086,8 +1372,14 @@ async def orm_pick_targets_to_autodelete(
     *,
     limit: int = 50,
     now: datetime | None = None,
+    owner: str | None = None,
+    lease_for: timedelta = timedelta(minutes=5),
 ) -> list[PostTarget]:
-    """Берем targets для автоудаления."""
+    """
+    Берем targets для автоудаления.
+    Если передан owner — targets захватываются арендой (как в orm_claim_targets_to_send),
+    чтобы два процесса не удаляли одно и то же.
+    """
     if now is None:
         now = datetime.utcnow()
 
@@ -1100,14 +1392,91 @@ async def orm_pick_targets_to_autodelete(
         .order_by(PostTarget.auto_delete_at.asc(), PostTarget.id.asc())
         .limit(limit)
     )
-    res = await session.execute(q)
-    return list(res.scalars().all())
+    if owner is None:
+        res = await session.execute(q)
+        return list(res.scalars().all())
+
+    claimable = (
+        q.with_only_columns(PostTarget.id)
+        .where(_lease_is_free(now))
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(PostTarget)
+        .where(PostTarget.id.in_(claimable.scalar_subquery()))
+        .values(lease_owner=owner, lease_expires_at=now + lease_for)
+        .returning(PostTarget)
+        .execution_options(synchronize_session=False)
+    )
+    res = await session.scalars(stmt)
+    return sorted(res.all(), key=lambda t: (t.auto_delete_at, t.id))
+
+
+async def orm_get_upcoming_deadlines(
+    session: AsyncSession,
+    *,
+    limit: int = 50,
+    now: datetime | None = None,
+) -> list[datetime]:
+    """
+    Ближайшие дедлайны планировщика для кучи в памяти (database.deadlines):
+    publish_at из ix_post_targets_state_publish, auto_delete_at (но не раньше, чем истечёт
+    аренда) и queued targets (без аренды — сейчас, иначе когда истечёт аренда /
+    наступит next_attempt_at). Дедлайн под живой арендой не будит планировщик зря:
+    забрать такой target всё равно нельзя.
+    """
+    if now is None:
+        now = datetime.utcnow()
+
+    q_publish = (
+        select(PostTarget.publish_at)
+        .where(PostTarget.state == TargetState.scheduled)
+        .where(PostTarget.publish_at.is_not(None))
+        .order_by(PostTarget.publish_at.asc())
+        .limit(limit)
+    )
+    delete_at = func.greatest(
+        func.coalesce(PostTarget.lease_expires_at, now),
+        PostTarget.auto_delete_at,
+    )
+    q_delete = (
+        select(delete_at)
+        .where(PostTarget.auto_deleted.is_(False))
+        .where(PostTarget.auto_delete_at.is_not(None))
+        .where(PostTarget.state == TargetState.sent)
+        .order_by(delete_at.asc())
+        .limit(limit)
+    )
+    q_queued = (
+        select(func.min(func.greatest(
+            func.coalesce(PostTarget.lease_expires_at, now),
+            func.coalesce(PostTarget.next_attempt_at, now),
+        )))
+        .where(PostTarget.state == TargetState.queued)
+    )
+
+    deadlines = list((await session.scalars(q_publish)).all())
+    deadlines += list((await session.scalars(q_delete)).all())
+    queued_at = await session.scalar(q_queued)
+    if queued_at is not None:
+        deadlines.append(queued_at)
+    return sorted(deadlines)
 
 
 async def orm_mark_target_autodeleted(session: AsyncSession, *, target_id: int) -> None:
-    t = await orm_get_target(session, target_id=target_id)
-    t.auto_deleted = True
-    await session.flush()
+    await orm_mark_targets_autodeleted(session, target_ids=[target_id])
+
+
+async def orm_mark_targets_autodeleted(session: AsyncSession, *, target_ids: Sequence[int]) -> None:
+    """Пометить пачку targets удалёнными одним UPDATE (и снять аренду)."""
+    if not target_ids:
+        return
+    await session.execute(
+        update(PostTarget)
+        .where(PostTarget.id.in_(target_ids))
+        .values(auto_deleted=True, lease_owner=None, lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
 
 
 # ---------------------------------------------------------------------
@@ -1295,6 +1664,21 @@ async def orm_log_post_event(
     return event
 
 
+async def orm_log_post_events(
+    session: AsyncSession,
+    *,
+    event_type: PostEventType,
+    events: Iterable[tuple[int, int | None, dict | None]],
+) -> None:
+    """Пакетная запись событий одного типа: events — (post_id, target_id, payload)."""
+    rows = [
+        {"post_id": post_id, "target_id": target_id, "payload": payload, "event_type": event_type}
+        for post_id, target_id, payload in events
+    ]
+    if rows:
+        await session.execute(insert(PostEvent), rows)
+
+
 async def orm_get_post_events(
     session: AsyncSession,
     *,
@@ -1312,6 +1696,163 @@ async def orm_get_post_events(
     return list(res.scalars().all())
 
 
+# ---------------------------------------------------------------------
+# Reactions
+# ---------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class ReactionButtonState:
+    """Кнопка-реакция со свежим счётчиком (click_count + слоты, без ORM-объекта)."""
+    id: int
+    emoji: str
+    row: int
+    position: int
+    click_count: int
+
+
+@dataclass(frozen=True)
+class ReactionToggle:
+    """
+    Результат нажатия: добавлен ли клик, изменение счётчика нажатой кнопки (+1 / -1 / 0),
+    все реакции поста (click_count — закоммиченный в БД) и клики пользователя на них.
+    """
+    post_id: int
+    button_id: int
+    user_id: int
+    added: bool
+    delta: int
+    buttons: list[ReactionButtonState]
+    user_clicks: set[int]
+
+
+# Один запрос: клик удаляется, если был, иначе вставляется (двойное нажатие
+# упирается в ON CONFLICT, и delta = 0). Счётчик здесь не трогается — изменения
+# пачкой пишет orm_apply_reaction_deltas (см. utils/reaction_aggregator.py);
+# итог кнопки — click_count плюс ещё не свёрнутые слоты post_reaction_counter_shards.
+# Все части CTE видят один снимок, поэтому клик нажатой кнопки берётся из ins.
+_TOGGLE_REACTION_SQL = text("""
+WITH del AS (
+    DELETE FROM reaction_clicks
+    WHERE button_id = :button_id AND user_id = :user_id
+    RETURNING button_id
+),
+ins AS (
+    INSERT INTO reaction_clicks (button_id, user_id)
+    SELECT :button_id, :user_id
+    WHERE NOT EXISTS (SELECT 1 FROM del)
+      AND EXISTS (SELECT 1 FROM post_reaction_buttons WHERE id = :button_id)
+    ON CONFLICT DO NOTHING
+    RETURNING button_id
+),
+pressed AS (
+    SELECT post_id FROM post_reaction_buttons WHERE id = :button_id
+)
+SELECT
+    b.id,
+    b.post_id,
+    b.emoji,
+    b."row",
+    b."position",
+    b.click_count + COALESCE(
+        (SELECT sum(s.delta) FROM post_reaction_counter_shards s WHERE s.button_id = b.id), 0
+    ) AS click_count,
+    CASE
+        WHEN b.id = :button_id THEN EXISTS (SELECT 1 FROM ins)
+        ELSE EXISTS (
+            SELECT 1 FROM reaction_clicks c
+            WHERE c.button_id = b.id AND c.user_id = :user_id
+        )
+    END AS clicked,
+    (SELECT count(*) FROM ins) - (SELECT count(*) FROM del) AS delta
+FROM pressed
+JOIN post_reaction_buttons b ON b.post_id = pressed.post_id
+ORDER BY b."row", b."position"
+""")
+
+
+async def orm_toggle_reaction(
+    session: AsyncSession,
+    *,
+    button_id: int,
+    user_id: int,
+) -> ReactionToggle | None:
+    """Переключает клик пользователя за один запрос. None — кнопки нет."""
+    res = await session.execute(_TOGGLE_REACTION_SQL, {"button_id": button_id, "user_id": user_id})
+    rows = res.all()
+    if not rows:
+        return None
+    delta = int(rows[0].delta)
+    return ReactionToggle(
+        post_id=rows[0].post_id,
+        button_id=button_id,
+        user_id=user_id,
+        added=delta > 0,
+        delta=delta,
+        buttons=[
+            ReactionButtonState(
+                id=r.id, emoji=r.emoji, row=r.row, position=r.position, click_count=r.click_count,
+            )
+            for r in rows
+        ],
+        user_clicks={r.id for r in rows if r.clicked},
+    )
+
+
+async def orm_apply_reaction_deltas(session: AsyncSession, *, deltas: dict[tuple[int, int], int]) -> None:
+    """
+    Накопленные изменения счётчиков реакций ((button_id, shard) -> delta) одним upsert
+    в слоты: параллельные записи разных слотов не ждут блокировку одной строки.
+    """
+    rows = [
+        {"button_id": button_id, "shard": shard, "delta": d}
+        for (button_id, shard), d in sorted(deltas.items())
+        if d
+    ]
+    if not rows:
+        return
+    stmt = pg_insert(PostReactionCounterShard).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PostReactionCounterShard.button_id, PostReactionCounterShard.shard],
+        set_={"delta": PostReactionCounterShard.delta + stmt.excluded.delta},
+    )
+    await session.execute(stmt)
+
+
+# Слоты забираются DELETE ... RETURNING: upsert, пришедший после, создаст слот заново,
+# а строка, изменённая до удаления, вернётся уже с новым значением — изменения не теряются.
+_ROLLUP_REACTION_SHARDS_SQL = text("""
+WITH moved AS (
+    DELETE FROM post_reaction_counter_shards
+    RETURNING button_id, delta
+),
+totals AS (
+    SELECT button_id, sum(delta) AS delta FROM moved GROUP BY button_id
+)
+UPDATE post_reaction_buttons AS b
+SET click_count = GREATEST(0, b.click_count + totals.delta)
+FROM totals
+WHERE b.id = totals.button_id
+RETURNING b.id
+""")
+
+
+async def orm_rollup_reaction_shards(session: AsyncSession) -> int:
+    """Переносит слоты счётчиков в post_reaction_buttons.click_count; число обновлённых кнопок."""
+    res = await session.execute(_ROLLUP_REACTION_SHARDS_SQL)
+    return len(res.all())
+
+
+async def orm_get_post_keyboard_messages(session: AsyncSession, *, post_id: int) -> list[tuple[int, int]]:
+    """(chat_id, message_id) сообщений с клавиатурой поста во всех каналах, куда он отправлен."""
+    res = await session.execute(
+        select(PostTarget.channel_id, PostTarget.keyboard_message_id)
+        .where(PostTarget.post_id == post_id)
+        .where(PostTarget.state == TargetState.sent)
+        .where(PostTarget.keyboard_message_id.is_not(None))
+    )
+    return [(int(chat_id), int(message_id)) for chat_id, message_id in res.all()]
+
+
 # ---------------------------------------------------------------------
 # FSM UserState
 # ---------------------------------------------------------------------
@@ -1395,22 +1936,14 @@ async def orm_create_post_from_message(
     text = message.text or message.caption or None
 
 
-    entities = message.entities or message.caption_entities
-    entities_json = None
-    if entities:
-        entities_json = json.dumps([e.model_dump() for e in entities])
-
-    print(f"=== СОХРАНЕНИЕ ПОСТА ===")
-    print(f"text: {text}")
-    print(f"entities: {entities}")
-    print(f"entities_json: {entities_json}")
+    entities = dump_entities(message.entities or message.caption_entities)
 
     post = Post(
         author_id=user_id,
         text=text,
         created_at=datetime.utcnow(),
         source_chat_id=message.chat.id,
-        text_entities=entities_json,
+        text_entities=entities,
         source_message_id=message.message_id,
     )
     session.add(post)
@@ -1456,19 +1989,18 @@ async def orm_create_post_from_album(
         channel_ids,
 ) -> int:
     text = None
-    entities_json = None
+    entities = None
     for msg in messages:
         if msg.caption:
             text = msg.caption
-            if msg.caption_entities:
-                entities_json = json.dumps([e.model_dump() for e in msg.caption_entities])
+            entities = dump_entities(msg.caption_entities)
             break
     first_msg = messages[0] if messages else None
 
     post = Post(
         author_id=user_id,
         text=text,
-        text_entities=entities_json,
+        text_entities=entities,
         created_at=datetime.utcnow(),
         source_chat_id=first_msg.chat.id if first_msg else None,  # <-- ДОБАВИТЬ
         source_message_id=first_msg.message_id if first_msg else None,
@@ -1499,9 +2031,14 @@ async def orm_create_post_from_album(
     return int(post.id)
 
 
-async def orm_edit_post_text(session: AsyncSession, *, post_id: int, text: str | None):
+async def orm_edit_post_text(
+        session: AsyncSession, *, post_id: int, text: str | None, entities: list[dict] | None = None,
+):
+    # entities старого текста к новому не подходят — заменяются вместе с ним
     await session.execute(
-        update(Post).where(Post.id == post_id).values(text=text)
+        update(Post).where(Post.id == post_id).values(
+            text=text, text_entities=entities, version=Post.version + 1,
+        )
     )
 
 
@@ -1544,6 +2081,7 @@ async def orm_add_media_to_post(
         order_index=order_index,
     )
     session.add(media)
+    await _bump_post_version(session, post_id)
     await session.flush()
     return media.id
 
@@ -1644,6 +2182,7 @@ async def orm_save_post_buttons(
         )
         session.add(post_button)
 
+    await _bump_post_version(session, post_id)
     await session.flush()
 
 
@@ -1656,6 +2195,7 @@ async def orm_delete_post_buttons(session: AsyncSession, post_id: int) -> None:
 
     stmt = delete(PostButton).where(PostButton.post_id == post_id)
     await session.execute(stmt)
+    await _bump_post_version(session, post_id)
 
 
 async def orm_set_post_text_position(session: AsyncSession, *, post_id: int, position: str) -> None:
@@ -1663,6 +2203,7 @@ async def orm_set_post_text_position(session: AsyncSession, *, post_id: int, pos
     if not post:
         raise NotFound("post not found")
     post.text_position = position
+    post.version += 1
     await session.flush()
 
 
@@ -1694,6 +2235,8 @@ async def orm_save_hidden_part(
             nonsubscriber_text=nonsubscriber_text,
         )
         session.add(hidden_part)
+    await _bump_post_version(session, post_id)
+    signal_hidden_part_changed(session, post_id)
     await session.flush()
 
 
@@ -1702,6 +2245,8 @@ async def orm_delete_hidden_part(session: AsyncSession, *, post_id: int) -> None
     from sqlalchemy import delete
 
     await session.execute(delete(PostHiddenPart).where(PostHiddenPart.post_id == post_id))
+    await _bump_post_version(session, post_id)
+    signal_hidden_part_changed(session, post_id)
     await session.flush()
 
 
@@ -0,0 +1,11 @@
+from aiogram import Router, types
+
+from utils.bot_metadata import BOT_METADATA
+
+bot_membership_router = Router()
+
+
+@bot_membership_router.my_chat_member()
+async def bot_membership_changed(update: types.ChatMemberUpdated):
+    """Бота добавили / удалили / изменили его права — закэшированные данные чата устарели."""
+    BOT_METADATA.invalidate_chat(update.chat.id)
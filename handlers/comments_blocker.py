@@ -1,31 +1,73 @@
 from aiogram import Router, F, types, Bot
-from aiogram.exceptions import TelegramBadRequest
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
 from sqlalchemy.orm import selectinload
+from database.comments_policy import COMMENTS_POLICY, signal_comments_policy_changed
 from database.models import PostTarget, Channel, Post
+from database.orm_query import orm_find_target_by_message, orm_map_target_messages
 from filters.chat_types import ChatTypeFilter
+from utils.bot_metadata import BOT_METADATA
+from utils.deletion_queue import COMMENT_DELETIONS
+from utils.ttl_cache import MISSING
 
 comments_router = Router()
 comments_router.message.filter(ChatTypeFilter(["group", "supergroup"]))
 
 
+_WITH_POST = (selectinload(PostTarget.post),)
+
+
+async def _channel_id_by_linked_chat(session: AsyncSession, chat_id: int) -> int | None:
+    channel_id = COMMENTS_POLICY.channel_by_chat.get(chat_id, MISSING)
+    if channel_id is MISSING:
+        res = await session.execute(
+            select(Channel.id).where(Channel.linked_chat_id == chat_id)
+        )
+        channel_id = res.scalars().first()
+        COMMENTS_POLICY.channel_by_chat.set(chat_id, channel_id)
+    return channel_id
+
+
+def _remember_target(chat_id: int, message_id: int, target: PostTarget | None) -> None:
+    COMMENTS_POLICY.post_by_message.set((chat_id, message_id), target.post_id if target else None)
+    if target and target.post:
+        COMMENTS_POLICY.comments_enabled.set(target.post_id, target.post.comments_enabled)
+
+
+async def _post_id_by_message(session: AsyncSession, chat_id: int, message_id: int) -> int | None:
+    """post_id по сообщению (в канале или корню обсуждения); промахи тоже кэшируются."""
+    post_id = COMMENTS_POLICY.post_by_message.get((chat_id, message_id), MISSING)
+    if post_id is MISSING:
+        target = await orm_find_target_by_message(
+            session, chat_id=chat_id, message_id=message_id, options=_WITH_POST,
+        )
+        _remember_target(chat_id, message_id, target)
+        post_id = target.post_id if target else None
+    return post_id
+
+
+async def _comments_enabled(session: AsyncSession, post_id: int) -> bool:
+    enabled = COMMENTS_POLICY.comments_enabled.get(post_id, MISSING)
+    if enabled is MISSING:
+        res = await session.execute(select(Post.comments_enabled).where(Post.id == post_id))
+        enabled = res.scalar_one_or_none()
+        enabled = True if enabled is None else enabled
+        COMMENTS_POLICY.comments_enabled.set(post_id, enabled)
+    return enabled
+
+
 async def _find_target_by_message_id(
         session: AsyncSession,
         channel_id: int,
         msg_id: int
 ) -> PostTarget | None:
     """
-    Ищет PostTarget по sent_message_id ИЛИ по source_message_id (для репостов).
+    Ищет PostTarget по сообщению в канале (target_messages) ИЛИ по source_message_id (для репостов).
     """
-    # Сначала ищем по sent_message_id (обычные посты)
-    res = await session.execute(
-        select(PostTarget)
-        .where(PostTarget.channel_id == channel_id)
-        .where(PostTarget.sent_message_id == msg_id)
-        .options(selectinload(PostTarget.post))
+    # Сначала ищем по target_messages (обычные посты, любая часть альбома)
+    target = await orm_find_target_by_message(
+        session, chat_id=channel_id, message_id=msg_id, options=_WITH_POST,
     )
-    target = res.scalar_one_or_none()
 
     if target:
         return target
@@ -65,21 +107,13 @@ async def comments_guard(message: types.Message, session: AsyncSession):
         if not channel_id:
             return
 
-        channel = await session.get(Channel, channel_id)
-        if not channel:
-            return
-
         target = None
 
         # Случай A: Обычный пост (forward_from_message_id есть)
         if forward_msg_id:
-            res = await session.execute(
-                select(PostTarget)
-                .where(PostTarget.channel_id == channel_id)
-                .where(PostTarget.sent_message_id == forward_msg_id)
-                .options(selectinload(PostTarget.post))
+            target = await orm_find_target_by_message(
+                session, chat_id=channel_id, message_id=forward_msg_id, options=_WITH_POST,
             )
-            target = res.scalar_one_or_none()
 
         # Случай B: Репост (forward_from_message_id = None)
         # Ищем последний target с is_repost=True где discussion_message_id ещё не заполнен
@@ -97,25 +131,24 @@ async def comments_guard(message: types.Message, session: AsyncSession):
             )
             target = res.scalar_one_or_none()
 
-            # Сохраняем discussion_message_id для будущих поисков
-            if target:
-                target.discussion_message_id = discussion_msg_id
-                await session.commit()
-                print(f"[COMMENTS] Сохранён discussion_message_id={discussion_msg_id} для target_id={target.id}")
-
         if not target or not target.post:
             print(f"[COMMENTS] Target не найден")
             return
 
+        # Корень обсуждения -> target: комментарии в этой ветке находятся одним поиском
+        if target.discussion_message_id is None:
+            target.discussion_message_id = discussion_msg_id
+        await orm_map_target_messages(
+            session, target_id=target.id, chat_id=chat_id, message_ids=[discussion_msg_id],
+        )
+        await session.commit()
+        _remember_target(chat_id, discussion_msg_id, target)
+
         print(
             f"[COMMENTS] Пост id={target.post.id}, is_repost={target.post.is_repost}, comments={target.post.comments_enabled}")
 
         if not target.post.comments_enabled:
-            try:
-                await message.delete()
-                print("[COMMENTS] Удалён корень обсуждения")
-            except Exception as e:
-                print(f"[COMMENTS] Ошибка удаления: {e}")
+            COMMENT_DELETIONS.enqueue(message.bot, chat_id, message.message_id)
         return
 
     # === 2) КОММЕНТАРИИ ПОЛЬЗОВАТЕЛЕЙ ===
@@ -125,51 +158,27 @@ async def comments_guard(message: types.Message, session: AsyncSession):
     if not thread_id and not reply_msg:
         return
 
-    # Ищем канал по linked_chat_id
-    res = await session.execute(
-        select(Channel).where(Channel.linked_chat_id == chat_id)
-    )
-    channel = res.scalar_one_or_none()
-    if not channel:
-        return
+    post_id = None
 
-    target = None
+    # Способ A: thread_id = ID корневого сообщения (автопересылки) в группе
+    if thread_id:
+        post_id = await _post_id_by_message(session, chat_id, thread_id)
 
-    # Способ A: По forward_from_message_id (обычные посты)
-    if reply_msg:
+    # Способ B: По forward_from_message_id (корень обсуждения не был сохранён)
+    if post_id is None and reply_msg:
         forward_msg_id = getattr(reply_msg, "forward_from_message_id", None)
         if forward_msg_id:
-            res = await session.execute(
-                select(PostTarget)
-                .where(PostTarget.channel_id == channel.id)
-                .where(PostTarget.sent_message_id == forward_msg_id)
-                .options(selectinload(PostTarget.post))
-            )
-            target = res.scalar_one_or_none()
+            # Ищем канал по linked_chat_id
+            channel_id = await _channel_id_by_linked_chat(session, chat_id)
+            if channel_id:
+                post_id = await _post_id_by_message(session, channel_id, forward_msg_id)
 
-    # Способ B: По discussion_message_id (репосты)
-    # thread_id = ID корневого сообщения в группе = discussion_message_id
-    if not target and thread_id:
-        res = await session.execute(
-            select(PostTarget)
-            .where(PostTarget.channel_id == channel.id)
-            .where(PostTarget.discussion_message_id == thread_id)
-            .options(selectinload(PostTarget.post))
-        )
-        target = res.scalar_one_or_none()
-
-    if not target or not target.post:
-        print(f"[COMMENTS] Target не найден для комментария")
+    if post_id is None:
         return
 
-    print(f"[COMMENTS] Пост id={target.post.id}, comments={target.post.comments_enabled}")
-
-    if not target.post.comments_enabled:
-        try:
-            await message.delete()
-            print("[COMMENTS] Удалён комментарий")
-        except Exception as e:
-            print(f"[COMMENTS] Ошибка: {e}")
+    if not await _comments_enabled(session, post_id):
+        # удаляется пачкой в фоне, обработчик не ждёт запроса к API
+        COMMENT_DELETIONS.enqueue(message.bot, chat_id, message.message_id)
 
 
 async def update_channel_linked_chat(
@@ -179,7 +188,7 @@ async def update_channel_linked_chat(
 ) -> int | None:
     """Получает и сохраняет linked_chat_id канала."""
     try:
-        chat = await bot.get_chat(channel_id)
+        chat = await BOT_METADATA.get_chat(bot, channel_id)
         linked_chat_id = getattr(chat, 'linked_chat_id', None)
 
         if linked_chat_id:
@@ -188,6 +197,7 @@ async def update_channel_linked_chat(
                 .where(Channel.id == channel_id)
                 .values(linked_chat_id=linked_chat_id)
             )
+            signal_comments_policy_changed(session)
             await session.commit()
 
         return linked_chat_id
@@ -198,8 +208,7 @@ async def update_channel_linked_chat(
 async def check_bot_can_delete_in_chat(bot: Bot, chat_id: int) -> bool:
     """Проверяет, может ли бот удалять сообщения в чате."""
     try:
-        me = await bot.get_me()
-        member = await bot.get_chat_member(chat_id, me.id)
+        member = await BOT_METADATA.get_bot_member(bot, chat_id)
 
         if hasattr(member, 'can_delete_messages'):
             return member.can_delete_messages
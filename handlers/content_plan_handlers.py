@@ -28,6 +28,7 @@ from database.orm_query import (
 )
 
 from kbds.inline import ik_create_root_menu
+from scheduler_worker import render_post_cached
 
 
 # =============================================================================
@@ -580,7 +581,8 @@ async def content_plan_post_view(call: types.CallbackQuery, callback_data: Conte
     except Exception:
         pass
 
-    # Отправляем превью поста
+    # Отправляем превью поста (HTML тот же, что уйдёт в канал)
+    html_text = render_post_cached(post).html_text or None
     if post.media:
         media = sorted(post.media, key=lambda m: m.order_index)
         first_media = media[0]
@@ -588,22 +590,22 @@ async def content_plan_post_view(call: types.CallbackQuery, callback_data: Conte
         if first_media.media_type.value == "photo":
             await call.message.answer_photo(
                 photo=first_media.file_id,
-                caption=post.text,
+                caption=html_text,
             )
         elif first_media.media_type.value == "video":
             await call.message.answer_video(
                 video=first_media.file_id,
-                caption=post.text,
+                caption=html_text,
             )
         elif first_media.media_type.value == "document":
             await call.message.answer_document(
                 document=first_media.file_id,
-                caption=post.text,
+                caption=html_text,
             )
         else:
-            await call.message.answer(post.text or "Пост без текста")
+            await call.message.answer(html_text or "Пост без текста")
     else:
-        await call.message.answer(post.text or "Пост без текста")
+        await call.message.answer(html_text or "Пост без текста")
 
     # Отправляем информацию
     await call.message.answer(
@@ -742,6 +744,7 @@ async def content_plan_post_edit(call: types.CallbackQuery, callback_data: Conte
         pass
 
     # Отправляем пост как превью
+    html_text = render_post_cached(post).html_text or None
     if post.media:
         media = sorted(post.media, key=lambda m: m.order_index)
         first_media = media[0]
@@ -749,17 +752,17 @@ async def content_plan_post_edit(call: types.CallbackQuery, callback_data: Conte
         if first_media.media_type.value == "photo":
             res = await call.message.answer_photo(
                 photo=first_media.file_id,
-                caption=post.text,
+                caption=html_text,
             )
         elif first_media.media_type.value == "video":
             res = await call.message.answer_video(
                 video=first_media.file_id,
-                caption=post.text,
+                caption=html_text,
             )
         else:
-            res = await call.message.answer(post.text or "​")
+            res = await call.message.answer(html_text or "​")
     else:
-        res = await call.message.answer(post.text or "​")
+        res = await call.message.answer(html_text or "​")
 
     # Создаём EditorState
     from kbds.post_editor import EditorContext
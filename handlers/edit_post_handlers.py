@@ -8,7 +8,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.exceptions import TelegramBadRequest
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from sqlalchemy import update
 from sqlalchemy.orm import joinedload
 
 from filters.chat_types import ChatTypeFilter
@@ -19,8 +19,12 @@ from kbds.post_editor import (
     editor_ctx_to_dict, editor_ctx_from_dict,
     _with_check,
 )
-from database.orm_query import orm_get_user
+from database.comments_policy import signal_comments_policy_changed
+from database.deadlines import signal_deadline
+from database.orm_query import orm_get_user, orm_find_target_by_message, orm_get_post_full
 from database.models import PostTarget, Post, TargetState, PostHiddenPart
+from scheduler_worker import render_post_cached
+from utils.entities_html import dump_entities
 
 edit_post_router = Router()
 edit_post_router.message.filter(ChatTypeFilter(["private"]))
@@ -362,27 +366,27 @@ async def edit_post_receive_forward(message: types.Message, state: FSMContext, s
         return
 
     # Ищем в БД
-    q = (
-        select(PostTarget)
-        .where(PostTarget.channel_id == chat.id)
-        .where(PostTarget.sent_message_id == forward_msg_id)
-        .options(
+    target = await orm_find_target_by_message(
+        session,
+        chat_id=chat.id,
+        message_id=forward_msg_id,
+        options=(
             joinedload(PostTarget.post).selectinload(Post.media),
             joinedload(PostTarget.post).selectinload(Post.buttons),
             joinedload(PostTarget.post).joinedload(Post.hidden_part),
-        )
+        ),
     )
-    result = await session.execute(q)
-    target = result.unique().scalars().first()
 
     # Извлекаем данные
     post_id, target_id, timer_minutes = 0, 0, 0
+    keyboard_message_id = None
     original_text = None
     db_bell, db_reactions, db_protect, db_pin, db_comments = True, False, False, False, False
     db_text_pos, db_has_btns, db_has_hidden = "bottom", False, False
 
     if target:
         target_id, post_id = target.id, target.post_id
+        keyboard_message_id = target.keyboard_message_id
         post = target.post
         original_text = post.text
         db_bell = not post.silent
@@ -441,6 +445,7 @@ async def edit_post_receive_forward(message: types.Message, state: FSMContext, s
         edit_message_id=forward_msg_id,
         edit_target_id=target_id,
         edit_post_id=post_id,
+        edit_keyboard_message_id=keyboard_message_id,
         edit_new_text=original_text,
         text_changed=False,
         timer_minutes=timer_minutes,
@@ -567,6 +572,7 @@ async def edit_post_receive_new_text(message: types.Message, state: FSMContext):
 
     await state.update_data(
         edit_new_text=new_text,
+        edit_new_entities=dump_entities(message.entities),
         text_changed=True,
         editor_context=editor_ctx_to_dict(ctx)
     )
@@ -786,6 +792,7 @@ async def edit_post_confirm(call: types.CallbackQuery, state: FSMContext, sessio
     channel_id = data.get("edit_channel_id")
     message_id = data.get("edit_message_id")
     target_id = data.get("edit_target_id")
+    keyboard_message_id = data.get("edit_keyboard_message_id")
     new_text = data.get("edit_new_text")
     text_changed = data.get("text_changed", False)
 
@@ -844,18 +851,37 @@ async def edit_post_confirm(call: types.CallbackQuery, state: FSMContext, sessio
                         "pinned": st.pin,
                         "comments_enabled": st.comments,
                         "text_position": st.text_position,
+                        "version": Post.version + 1,
                     }
                     if new_text and text_changed:
                         update_values["text"] = new_text
+                        update_values["text_entities"] = data.get("edit_new_entities")
 
                     await session.execute(
                         update(Post).where(Post.id == target.post_id).values(**update_values)
                     )
+                    signal_comments_policy_changed(session, target.post_id)
                     target.auto_delete_after = auto_delete_after
                     target.auto_delete_at = (datetime.utcnow() + auto_delete_after) if auto_delete_after else None
+                    signal_deadline(session, target.auto_delete_at)
                     await session.commit()
                     success.append("БД")
 
+                    # 4. Кнопки: правка текста сообщения с клавиатурой убирает её,
+                    # поэтому клавиатура сообщения с кнопками перерисовывается по посту из БД
+                    if keyboard_message_id:
+                        post = await orm_get_post_full(session, post_id=target.post_id)
+                        try:
+                            await call.bot.edit_message_reply_markup(
+                                chat_id=channel_id,
+                                message_id=keyboard_message_id,
+                                reply_markup=render_post_cached(post).keyboard,
+                            )
+                            success.append("кнопки")
+                        except TelegramBadRequest as e:
+                            if "not modified" not in str(e):
+                                errors.append("кнопки")
+
             await state.clear()
 
             result = f"<tg-emoji emoji-id=\"{PREMIUM_EMOJI['sign']}\">✍✅</tg-emoji> <b>Изменения применены!</b>\n\nКанал: {data.get('edit_channel_title', 'Канал')}"
@@ -879,13 +905,16 @@ async def edit_post_confirm(call: types.CallbackQuery, state: FSMContext, sessio
                         "pinned": st.pin,
                         "comments_enabled": st.comments,
                         "text_position": st.text_position,
+                        "version": Post.version + 1,
                     }
                     if new_text and text_changed:
                         update_values["text"] = new_text
+                        update_values["text_entities"] = data.get("edit_new_entities")
 
                     await session.execute(
                         update(Post).where(Post.id == target.post_id).values(**update_values)
                     )
+                    signal_comments_policy_changed(session, target.post_id)
                     target.auto_delete_after = auto_delete_after
                     await session.commit()
 
@@ -1,9 +1,36 @@
-from aiogram import Router, F, types
+import asyncio
+import logging
+
+from aiogram import Bot, Router, F, types
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from sqlalchemy.ext.asyncio import AsyncSession
-from database.orm_query import orm_get_hidden_part, orm_get_post_with_channel
+
+from database.hidden_parts import get_hidden_part_view
+from utils.bot_metadata import BOT_METADATA
+
+logger = logging.getLogger(__name__)
 
 hidden_callback_router = Router()
 
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+async def _is_subscribed(bot: Bot, channel_id: int, user_id: int) -> bool | None:
+    """Подписан ли пользователь; None — проверить не удалось (бот удалён из канала, сеть, флуд)."""
+    # статус кэширует BOT_METADATA; «не подписан» живёт там лишь несколько секунд
+    try:
+        member = await BOT_METADATA.get_chat_member(bot, channel_id, user_id)
+    except TelegramBadRequest as e:
+        # пользователь ни разу не был в канале
+        if "user not found" in e.message.lower():
+            return False
+        logger.warning(f"[hidden] subscription check {channel_id}/{user_id} failed: {e}")
+        return None
+    except (TelegramAPIError, asyncio.TimeoutError) as e:
+        logger.warning(f"[hidden] subscription check {channel_id}/{user_id} failed: {e}")
+        return None
+    return member.status in SUBSCRIBED_STATUSES
+
 
 @hidden_callback_router.callback_query(F.data.startswith("hidden:"))
 async def hidden_content_click(call: types.CallbackQuery, session: AsyncSession):
@@ -15,25 +42,22 @@ async def hidden_content_click(call: types.CallbackQuery, session: AsyncSession)
 
     user_id = call.from_user.id
 
-    hidden = await orm_get_hidden_part(session, post_id=post_id)
+    # обычно из кэша, без запросов к БД
+    hidden = await get_hidden_part_view(session, post_id)
     if not hidden:
         await call.answer("Контент недоступен", show_alert=True)
         return
 
-    post = await orm_get_post_with_channel(session, post_id=post_id)
-    if not post or not post.targets:
-        await call.answer("Контент недоступен", show_alert=True)
-        return
+    # подписку проверяем в канале, где нажали кнопку (если это канал поста)
+    channel_id = hidden.channel_ids[0]
+    if call.message and call.message.chat.id in hidden.channel_ids:
+        channel_id = call.message.chat.id
 
-    channel_id = post.targets[0].channel_id
-
-    try:
-        member = await call.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-        is_subscribed = member.status in ("member", "administrator", "creator")
-    except Exception:
-        is_subscribed = False
+    is_subscribed = await _is_subscribed(call.bot, channel_id, user_id)
 
-    if is_subscribed:
+    if is_subscribed is None:
+        await call.answer("Не удалось проверить подписку, попробуйте позже", show_alert=True)
+    elif is_subscribed:
         text = hidden.subscriber_text
         if len(text) > 200:
             try:
@@ -1,4 +1,3 @@
-import asyncio
 import re
 from typing import Optional, Tuple
 from datetime import timezone, date
@@ -9,8 +8,8 @@ from sqlalchemy import select, delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram.types import Message, ContentType, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
-from sqlalchemy.orm import selectinload
 
+from database.comments_policy import signal_comments_policy_changed
 from database.models import TgMemberStatus, PostEventType, TargetState, PostTarget
 from database.orm_query import orm_get_user_channels, orm_get_free_channels_for_user, orm_get_folder_channels, \
     orm_get_user_folders, orm_add_channel_admin, orm_upsert_channel, orm_upsert_user, orm_create_post_from_message, \
@@ -42,8 +41,12 @@ from kbds.media_group_buffer import MEDIA_GROUP_BUFFER, _finalize_album
 from kbds.post_editor import editor_state_to_dict, build_editor_kb, EditorState, TOGGLE_KEYS, editor_state_from_dict, \
     EditorCD, EditTextCD, make_ctx_from_message, CopyPostCD
 from kbds.post_editor import UrlButtonsCD, build_url_buttons_prompt_kb, merge_url_and_editor_kb
-from database.orm_query import orm_save_post_buttons, orm_delete_post_buttons, orm_get_post_buttons
+from database.orm_query import orm_save_post_buttons, orm_delete_post_buttons, orm_get_post_buttons, orm_toggle_reaction
 from database.models import PostReactionButton, ReactionClick, Post
+from scheduler_worker import render_post_cached
+from utils.bot_metadata import BOT_METADATA
+from utils.entities_html import dump_entities
+from utils.reaction_aggregator import REACTION_AGGREGATOR
 
 from zoneinfo import ZoneInfo
 
@@ -466,13 +469,10 @@ async def _check_bot_rights(bot: Bot, channel_id: int) -> Tuple[bool, str, list[
     """
     Проверяем права бота. Возвращает (ok, error, warnings).
     """
-    me = await bot.get_me()
     try:
-        member = await bot.get_chat_member(channel_id, me.id)
+        member = await BOT_METADATA.get_bot_member(bot, channel_id)
     except TelegramBadRequest:
         return False, "Не удалось получить статус бота в канале.", []
-    print(f"[DEBUG] member: {member}")
-    print(f"[DEBUG] status: {member.status}")
     status = getattr(member, "status", None)
     if status not in ("administrator", "creator"):
         return False, "Бот не является администратором канала.", []
@@ -537,7 +537,7 @@ async def connect_channel_message(message: types.Message, state: FSMContext, ses
             return
 
         try:
-            chat = await bot.get_chat(ref)
+            chat = await BOT_METADATA.get_chat(bot, ref)
             channel_id = chat.id
             print(f"[ADD_CHANNEL] Resolved channel_id: {channel_id}")
         except Exception as e:
@@ -546,7 +546,7 @@ async def connect_channel_message(message: types.Message, state: FSMContext, ses
             return
     else:
         try:
-            chat = await bot.get_chat(channel_id)
+            chat = await BOT_METADATA.get_chat(bot, channel_id)
         except Exception as e:
             print(f"[ADD_CHANNEL] Error getting chat by id: {e}")
             await message.answer("Не удалось получить информацию о канале. Попробуйте ещё раз.")
@@ -637,7 +637,6 @@ async def connect_channel_message(message: types.Message, state: FSMContext, ses
     )
 
 
-ALBUM_WAIT_SECONDS = 1.0
 #Кнопки редактирования. Пользователь присалал сообщение.
 @user_private_router.message(StateFilter(CreatePostStates.composing))
 async def on_compose_any_message(message: types.Message, state: FSMContext, session: AsyncSession):
@@ -653,8 +652,8 @@ async def on_compose_any_message(message: types.Message, state: FSMContext, sess
 
         # если это первое сообщение альбома — планируем финализацию
         if bucket.task is None:
-            bucket.task = asyncio.create_task(
-                _finalize_album(key=key, state=state, session=session)
+            bucket.task = MEDIA_GROUP_BUFFER.spawn(
+                _finalize_album(key=key, state=state)
             )
 
         # Ничего не отвечаем на каждую часть альбома (иначе будет спам)
@@ -888,8 +887,10 @@ async def edit_text_receive_new_text(message: types.Message, state: FSMContext,
     album_caption_message_id = data.get("album_caption_message_id")
 
     new_text = (message.text or "").strip()
+    # strip() сдвигает offset'ы entities — сохраняем их, только если текст не изменился
+    new_entities = dump_entities(message.entities) if new_text == message.text else None
 
-    await orm_edit_post_text(session, post_id=post_id, text=new_text)
+    await orm_edit_post_text(session, post_id=post_id, text=new_text, entities=new_entities)
     await session.commit()
 
     editor = editor_state_from_dict(data["editor"])
@@ -2341,6 +2342,8 @@ async def publish_confirm_yes(call: types.CallbackQuery, callback_data: PublishC
             t.state = TargetState.draft
             t.sent_at = None
             t.sent_message_id = None
+            t.sent_message_ids = None
+            t.keyboard_message_id = None
         await orm_set_target_autodelete(
             session,
             actor_user_id=call.from_user.id,
@@ -2825,7 +2828,14 @@ async def hidden_part_save_edited_name(message: types.Message, state: FSMContext
 
     existing = await orm_get_hidden_part(session, post_id=post_id)
     if existing:
-        existing.button_text = new_name
+        # через orm_save_hidden_part: новая версия поста и сброс кэша скрытых частей
+        await orm_save_hidden_part(
+            session,
+            post_id=post_id,
+            button_text=new_name,
+            subscriber_text=existing.subscriber_text,
+            nonsubscriber_text=existing.nonsubscriber_text,
+        )
         await session.commit()
 
     await state.set_state(CreatePostStates.composing)
@@ -2862,7 +2872,13 @@ async def hidden_part_save_edited_text(message: types.Message, state: FSMContext
 
     existing = await orm_get_hidden_part(session, post_id=post_id)
     if existing:
-        existing.subscriber_text = new_text
+        await orm_save_hidden_part(
+            session,
+            post_id=post_id,
+            button_text=existing.button_text,
+            subscriber_text=new_text,
+            nonsubscriber_text=existing.nonsubscriber_text,
+        )
         await session.commit()
 
     await state.set_state(CreatePostStates.composing)
@@ -2899,7 +2915,13 @@ async def hidden_part_save_edited_hidden_text(message: types.Message, state: FSM
 
     existing = await orm_get_hidden_part(session, post_id=post_id)
     if existing:
-        existing.nonsubscriber_text = new_text
+        await orm_save_hidden_part(
+            session,
+            post_id=post_id,
+            button_text=existing.button_text,
+            subscriber_text=existing.subscriber_text,
+            nonsubscriber_text=new_text,
+        )
         await session.commit()
 
     await state.set_state(CreatePostStates.composing)
@@ -3460,62 +3482,31 @@ async def reaction_click(
     - Если уже кликал - убираем клик (toggle)
     """
 
-    button_id = callback_data.button_id
-    user_id = call.from_user.id
-
-    # Получаем кнопку с постом
-    btn = await session.get(PostReactionButton, button_id, options=[
-        selectinload(PostReactionButton.post).selectinload(Post.reaction_buttons)
-    ])
-
-    if not btn:
+    toggle = await orm_toggle_reaction(
+        session, button_id=callback_data.button_id, user_id=call.from_user.id,
+    )
+    if toggle is None:
         await call.answer("Кнопка не найдена", show_alert=True)
         return
-
-    # Проверяем, кликал ли пользователь
-    existing_click = await session.execute(
-        select(ReactionClick).where(
-            ReactionClick.button_id == button_id,
-            ReactionClick.user_id == user_id
-        )
-    )
-    existing = existing_click.scalar_one_or_none()
-
-    if existing:
-        # Убираем клик (toggle off)
-        await session.delete(existing)
-        btn.click_count = max(0, btn.click_count - 1)
-        action = "removed"
-    else:
-        # Добавляем клик
-        new_click = ReactionClick(button_id=button_id, user_id=user_id)
-        session.add(new_click)
-        btn.click_count += 1
-        action = "added"
-
     await session.commit()
 
-    # Получаем все клики пользователя для этого поста
-    user_clicks_q = await session.execute(
-        select(ReactionClick.button_id).where(
-            ReactionClick.user_id == user_id,
-            ReactionClick.button_id.in_([b.id for b in btn.post.reaction_buttons])
-        )
-    )
-    user_clicks = set(row[0] for row in user_clicks_q.all())
-
-    # Обновляем клавиатуру
-    # Перезагружаем кнопки для актуальных счётчиков
-    await session.refresh(btn.post, ["reaction_buttons"])
-
-    new_kb = build_reaction_keyboard(btn.post.reaction_buttons, user_clicks)
-
-    try:
-        await call.message.edit_reply_markup(reply_markup=new_kb)
-    except TelegramBadRequest:
-        pass
-
-    await call.answer()
+    # счётчик и перерисовка клавиатуры — пачкой в фоне
+    message = call.message if isinstance(call.message, Message) else None
+    REACTION_AGGREGATOR.record(
+        call.bot,
+        toggle,
+        chat_id=message.chat.id if message else None,
+        message_id=message.message_id if message else None,
+        markup=message.reply_markup if message else None,
+    )
+
+    emoji = next((b.emoji for b in toggle.buttons if b.id == toggle.button_id), "")
+    if toggle.delta > 0:
+        await call.answer(f"Реакция {emoji} учтена")
+    elif toggle.delta < 0:
+        await call.answer(f"Реакция {emoji} снята")
+    else:
+        await call.answer()
 
 
 async def create_reaction_buttons(
@@ -3688,6 +3679,7 @@ async def editor_receive_reactions(message: types.Message, state: FSMContext, se
         post = await orm_get_post_full(session, post_id=post_id)
         if post:
             # Отправляем превью
+            html_text = render_post_cached(post).html_text or None
             if post.media:
                 media = sorted(post.media, key=lambda m: m.order_index)
                 first_media = media[0]
@@ -3695,23 +3687,23 @@ async def editor_receive_reactions(message: types.Message, state: FSMContext, se
                 if first_media.media_type.value == "photo":
                     res = await message.answer_photo(
                         photo=first_media.file_id,
-                        caption=post.text,
+                        caption=html_text,
                         reply_markup=build_editor_kb(post_id, st, ctx=editor_ctx),
                     )
                 elif first_media.media_type.value == "video":
                     res = await message.answer_video(
                         video=first_media.file_id,
-                        caption=post.text,
+                        caption=html_text,
                         reply_markup=build_editor_kb(post_id, st, ctx=editor_ctx),
                     )
                 else:
                     res = await message.answer(
-                        post.text or "​",
+                        html_text or "​",
                         reply_markup=build_editor_kb(post_id, st, ctx=editor_ctx),
                     )
             else:
                 res = await message.answer(
-                    post.text or "​",
+                    html_text or "​",
                     reply_markup=build_editor_kb(post_id, st, ctx=editor_ctx),
                 )
 
@@ -3762,6 +3754,7 @@ async def update_all_channels_linked_chat(bot, session_maker):
             except Exception as e:
                 print(f"❌ {channel.title}: {e}")
 
+        signal_comments_policy_changed(session)
         await session.commit()
         print("Done!")
 
@@ -1,22 +1,41 @@
 from __future__ import annotations
 
 import asyncio
+import logging
+import time
 from dataclasses import dataclass, field
 from typing import Dict, List, Tuple
 
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
-from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.orm_query import orm_create_post_from_album
+from database.engine import session_maker
+from database.orm_query import orm_create_post_from_album, orm_delete_post
 from kbds.post_editor import EditorState, editor_state_to_dict, build_editor_kb, make_ctx_from_message
 
-ALBUM_WAIT_SECONDS = 1.0
+# Адаптивное ожидание частей альбома: финализируем, когда части перестали приходить
+# (ALBUM_QUIET_SECONDS с последней), сразу при 10 частях, но не позже ALBUM_MAX_WAIT_SECONDS.
+# Тишина — как у прежнего фиксированного окна: на медленной сети клиенты присылают
+# части с паузами в сотни миллисекунд, и при меньшем окне альбом разваливается на посты.
+ALBUM_QUIET_SECONDS = 1.0
+ALBUM_MAX_WAIT_SECONDS = 3.0
+ALBUM_MAX_ITEMS = 10
+
+# Брошенные корзины (упавшая финализация и т.п.) живут не дольше BUCKET_TTL_SECONDS
+BUCKET_TTL_SECONDS = 60.0
+MAX_BUCKETS = 1000
+
+logger = logging.getLogger(__name__)
+
+
 @dataclass
 class AlbumBucket:
     messages: List[Message] = field(default_factory=list)
     task: asyncio.Task | None = None
+    created_at: float = field(default_factory=time.monotonic)
+    # выставляется на каждую новую часть — ожидание начинается заново
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
 
 
 class MediaGroupBuffer:
@@ -24,34 +43,91 @@ class MediaGroupBuffer:
     Буфер для сборки альбомов.
     Ключ: (chat_id, user_id, media_group_id)
     """
-    def __init__(self) -> None:
+    def __init__(self, *, ttl: float = BUCKET_TTL_SECONDS, max_buckets: int = MAX_BUCKETS) -> None:
         self._buckets: Dict[Tuple[int, int, str], AlbumBucket] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.ttl = ttl
+        self.max_buckets = max_buckets
 
     def add(self, key: Tuple[int, int, str], msg: Message) -> AlbumBucket:
         bucket = self._buckets.get(key)
         if bucket is None:
+            self._evict()
             bucket = AlbumBucket()
             self._buckets[key] = bucket
         bucket.messages.append(msg)
+        bucket.changed.set()
         return bucket
 
     def pop(self, key: Tuple[int, int, str]) -> AlbumBucket | None:
         return self._buckets.pop(key, None)
 
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, b in self._buckets.items() if now - b.created_at > self.ttl]:
+            self._drop(key)
+        # словарь хранит порядок вставки — самые старые корзины первые
+        while len(self._buckets) >= self.max_buckets:
+            self._drop(next(iter(self._buckets)))
+
+    def _drop(self, key: Tuple[int, int, str]) -> None:
+        bucket = self._buckets.pop(key)
+        if bucket.task is not None and not bucket.task.done():
+            bucket.task.cancel()
+        logger.warning(f"[album] dropped stale bucket {key} ({len(bucket.messages)} parts)")
+
+    async def wait_complete(self, key: Tuple[int, int, str]) -> AlbumBucket | None:
+        """Ждёт, пока альбом соберётся, и забирает корзину из буфера."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ALBUM_MAX_WAIT_SECONDS
+        while len(bucket.messages) < ALBUM_MAX_ITEMS:
+            timeout = min(ALBUM_QUIET_SECONDS, deadline - loop.time())
+            if timeout <= 0:
+                break
+            bucket.changed.clear()
+            try:
+                await asyncio.wait_for(bucket.changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+        return self.pop(key)
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Запускает финализацию; задача хранится до завершения, ошибки логируются."""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("[album] finalize failed", exc_info=task.exception())
+
+    async def close(self) -> None:
+        """Отменяет незавершённые финализации (остановка бота)."""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._buckets.clear()
+
+
 MEDIA_GROUP_BUFFER = MediaGroupBuffer()
 
 
 from aiogram.types import Message
 
-async def _finalize_album(key: tuple[int, int, str], state: FSMContext, session: AsyncSession):
+async def _finalize_album(key: tuple[int, int, str], state: FSMContext):
     """
     Финализация альбома.
     ИСПРАВЛЕНО: убран дублирующий вызов edit_message_reply_markup
+    Работает в фоне после того, как хендлер (и его сессия) завершился, поэтому
+    берёт свою короткую сессию из session_maker.
     """
     # ждём, пока Telegram пришлёт все элементы группы
-    await asyncio.sleep(ALBUM_WAIT_SECONDS)
-
-    bucket = MEDIA_GROUP_BUFFER.pop(key)
+    bucket = await MEDIA_GROUP_BUFFER.wait_complete(key)
     if not bucket or not bucket.messages:
         return
 
@@ -67,18 +143,38 @@ async def _finalize_album(key: tuple[int, int, str], state: FSMContext, session:
         # пользователь мог "сбросить" стейт — в этом случае просто ничего не делаем
         return
 
-    # 1) создаём пост в БД как "album"
-    post_id = await orm_create_post_from_album(
-        session=session,
-        user_id=album_msgs[0].from_user.id,
-        messages=album_msgs,
-        channel_ids=selected_ids,
+    async def _create_post() -> int:
+        async with session_maker() as session:
+            post_id = await orm_create_post_from_album(
+                session=session,
+                user_id=album_msgs[0].from_user.id,
+                messages=album_msgs,
+                channel_ids=selected_ids,
+            )
+            await session.commit()
+            return post_id
+
+    # 1) создаём пост в БД как "album" и
+    # 2) копируем все части альбома (будет "дублированный альбом") — параллельно
+    post_id, sent_messages = await asyncio.gather(
+        _create_post(),
+        _send_album_as_group(bot=bot, chat_id=chat_id, album_msgs=album_msgs),
+        return_exceptions=True,
     )
-    await session.commit()
-
-    # 2) копируем все части альбома (будет "дублированный альбом")
-    sent_messages = await _send_album_as_group(bot=bot, chat_id=chat_id, album_msgs=album_msgs)
-    if not sent_messages:
+    post_failed = isinstance(post_id, BaseException)
+    preview_failed = isinstance(sent_messages, BaseException) or not sent_messages
+    if post_failed or preview_failed:
+        # одна сторона удалась — убираем её, чтобы не осталось ни черновика без
+        # превью, ни превью без поста
+        if post_failed:
+            logger.error("[album] post creation failed", exc_info=post_id)
+        else:
+            await _delete_album_post(user_id=album_msgs[0].from_user.id, post_id=post_id)
+        if isinstance(sent_messages, BaseException):
+            logger.error("[album] preview send failed", exc_info=sent_messages)
+        elif sent_messages:
+            await _delete_preview(bot, chat_id, [m.message_id for m in sent_messages])
+        await bot.send_message(chat_id=chat_id, text="❌ Не удалось создать пост из альбома, отправьте его ещё раз.")
         return
 
     # 3) отдельное сообщение "Настройте пост…" + клавиатура
@@ -139,6 +235,22 @@ async def _finalize_album(key: tuple[int, int, str], state: FSMContext, session:
             raise
 
 
+async def _delete_album_post(*, user_id: int, post_id: int) -> None:
+    try:
+        async with session_maker() as session:
+            await orm_delete_post(session, actor_user_id=user_id, post_id=post_id)
+            await session.commit()
+    except Exception as e:
+        logger.error(f"[album] orphan post {post_id} not deleted: {e}")
+
+
+async def _delete_preview(bot, chat_id: int, message_ids: list[int]) -> None:
+    try:
+        await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+    except TelegramAPIError as e:
+        logger.warning(f"[album] preview {chat_id}/{message_ids} not deleted: {e}")
+
+
 def _to_input_media(msg: Message):
     """
     Преобразует Message в InputMedia*.
@@ -1,16 +1,25 @@
+import os
+
 from create_bot import dp, bot
 import asyncio
 
+from handlers.bot_membership import bot_membership_router
 from handlers.comments_blocker import comments_router
 from handlers.content_plan_handlers import content_plan_router
 from handlers.edit_post_handlers import edit_post_router
 from handlers.hidden_callback import hidden_callback_router
 from handlers.settings_handlers import settings_router
+from middlewares.comments_prefilter import CommentsPrefilterMiddleware
 from middlewares.db import DataBaseSession
-from database.engine import create_db, drop_db, session_maker
+from database.comments_policy import COMMENTS_POLICY
+from database.deadlines import listen_deadlines
+from database.engine import create_db, drop_db, session_maker, engine
 from handlers.user_private import user_private_router, update_all_channels_linked_chat
+from kbds.media_group_buffer import MEDIA_GROUP_BUFFER
+from utils.reaction_aggregator import REACTION_AGGREGATOR
 from scheduler_worker import scheduler_loop, check_auto_delete
 
+dp.include_router(bot_membership_router)
 dp.include_router(edit_post_router)
 dp.include_router(user_private_router)
 dp.include_router(comments_router)
@@ -26,14 +35,29 @@ async def on_startup():
     if run_param:
         await drop_db()
     await create_db()
-    dp["scheduler_task"] = asyncio.create_task(scheduler_loop(bot, session_maker))
+    # слоты счётчиков реакций, не свёрнутые до прошлой остановки
+    await REACTION_AGGREGATOR.rollup()
+    dp["deadlines_listener_task"] = asyncio.create_task(listen_deadlines(engine))
+    dp["scheduler_task"] = asyncio.create_task(scheduler_loop(
+        bot,
+        session_maker,
+        concurrency=int(os.getenv("PUBLISH_CONCURRENCY", "10")),
+        fanout_copy=os.getenv("PUBLISH_FANOUT_COPY", "0") == "1",
+    ))
     #asyncio.create_task(check_auto_delete(bot))
     #await update_all_channels_linked_chat(bot, session_maker)
 
 
+async def on_shutdown():
+    await MEDIA_GROUP_BUFFER.close()
+    await REACTION_AGGREGATOR.close()
+
+
 async def main():
     #await drop_db()
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    dp.update.outer_middleware(CommentsPrefilterMiddleware(COMMENTS_POLICY, session_maker))
     dp.update.middleware(DataBaseSession(session_pool=session_maker))
     await bot.delete_webhook(drop_pending_updates=True)
 
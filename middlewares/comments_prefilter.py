@@ -0,0 +1,44 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database.comments_policy import CommentsPolicy
+
+
+class CommentsPrefilterMiddleware(BaseMiddleware):
+    """
+    Внешняя мидлварь апдейтов: сообщения из групп, где нет постов с выключенными
+    комментариями, отбрасываются до открытия сессии БД (их всё равно обрабатывает
+    только comments_router, и ему нечего удалять).
+    Автопересылки из канала пропускаются всегда — по ним запоминается корень обсуждения.
+    """
+
+    def __init__(self, policy: CommentsPolicy, session_pool: async_sessionmaker):
+        self.policy = policy
+        self.session_pool = session_pool
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        message = event.message if isinstance(event, Update) else None
+        if (
+            message is None
+            or message.chat.type not in ("group", "supergroup")
+            or message.is_automatic_forward
+        ):
+            return await handler(event, data)
+
+        # не комментарий к посту
+        if not message.message_thread_id and not message.reply_to_message:
+            return None
+
+        blocked_chats = await self.policy.blocked_chats(self.session_pool)
+        if message.chat.id not in blocked_chats:
+            return None
+        return await handler(event, data)
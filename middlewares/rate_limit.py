@@ -0,0 +1,167 @@
+import asyncio
+import time
+from typing import Any
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, SendMediaGroup, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+# Лимиты Telegram Bot API: ~30 сообщений/с на бота, ~20 сообщений/мин в группу/канал,
+# ~1 сообщение/с в личный чат в среднем. Короткие всплески Telegram допускает, поэтому
+# запас личного чата вмещает альбом из 10 файлов и пару ответов интерфейса без ожидания.
+GLOBAL_RATE = 30.0
+GROUP_RATE = 20.0 / 60.0
+GROUP_BURST = 20.0
+PRIVATE_RATE = 1.0
+PRIVATE_BURST = 15.0
+
+# Методы, которые «тратят» сообщение в чате: отправка, редактирование, удаление, закрепление
+LIMITED_METHOD_PREFIXES = ("Send", "Copy", "Forward", "Edit", "Delete", "Pin", "Unpin")
+# в личном чате бот редактирует и удаляет только свои сообщения интерфейса — это
+# не новые сообщения, токены на них не тратятся
+PRIVATE_FREE_METHOD_PREFIXES = ("Edit", "Delete")
+
+
+def _is_private_chat(chat_id: int | str | None) -> bool:
+    # у групп/каналов отрицательные id (и @username вместо id)
+    return isinstance(chat_id, int) and chat_id > 0
+
+
+class TokenBucket:
+    """
+    Token bucket с резервированием: каждый запрос сразу забирает токен (баланс может уйти в минус)
+    и ждёт, пока баланс восстановится. Ожидающие обслуживаются строго в порядке прихода.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost: float = 1.0) -> float:
+        """Резервирует cost токенов, возвращает сколько секунд нужно подождать."""
+        self._refill(time.monotonic())
+        self.tokens -= cost
+        return max(0.0, -self.tokens / self.rate)
+
+    def wait_time(self) -> float:
+        """Сколько ждал бы новый запрос прямо сейчас."""
+        self._refill(time.monotonic())
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+    def penalize(self, seconds: float) -> None:
+        """Telegram ответил 429 — не отдаём токены ближайшие seconds секунд."""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Глобальный bucket на бота + bucket на каждый чат.
+    Сначала запрос ждёт в очереди своего чата, потом — в общей очереди,
+    поэтому «горячий» канал не занимает глобальные токены и не тормозит остальные.
+    """
+
+    def __init__(
+            self,
+            *,
+            global_rate: float = GLOBAL_RATE,
+            group_rate: float = GROUP_RATE,
+            group_burst: float = GROUP_BURST,
+            private_rate: float = PRIVATE_RATE,
+            private_burst: float = PRIVATE_BURST,
+            max_idle_buckets: int = 10_000,
+    ) -> None:
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.max_idle_buckets = max_idle_buckets
+        self._chats: dict[int | str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_idle_buckets:
+                self._drop_idle_buckets()
+            if _is_private_chat(chat_id):
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _drop_idle_buckets(self) -> None:
+        for chat_id in [k for k, b in self._chats.items() if b.is_idle()]:
+            del self._chats[chat_id]
+
+    async def acquire(self, chat_id: int | str | None, cost: float = 1.0) -> None:
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve(cost)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        delay = self.global_bucket.reserve(cost)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def penalize(self, chat_id: int | str | None, seconds: float) -> None:
+        if chat_id is None:
+            self.global_bucket.penalize(seconds)
+        else:
+            self._chat_bucket(chat_id).penalize(seconds)
+
+    def stats(self) -> dict[str, Any]:
+        """Текущие времена ожидания (секунды) — для логов/метрик."""
+        chat_waits = {chat_id: b.wait_time() for chat_id, b in self._chats.items()}
+        waiting = {chat_id: w for chat_id, w in chat_waits.items() if w > 0}
+        return {
+            "global_wait": self.global_bucket.wait_time(),
+            "chats_tracked": len(self._chats),
+            "chats_waiting": len(waiting),
+            "max_chat_wait": max(waiting.values(), default=0.0),
+            "slowest_chats": sorted(waiting.items(), key=lambda kv: kv[1], reverse=True)[:10],
+        }
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Мидлварь сессии Bot: все send/edit/delete/pin проходят через RateLimiter."""
+
+    def __init__(self, limiter: RateLimiter) -> None:
+        self.limiter = limiter
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        if not name.startswith(LIMITED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        if _is_private_chat(chat_id) and name.startswith(PRIVATE_FREE_METHOD_PREFIXES):
+            return await make_request(bot, method)
+        # альбом — это несколько сообщений
+        cost = float(len(method.media)) if isinstance(method, SendMediaGroup) else 1.0
+        await self.limiter.acquire(chat_id, cost)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.limiter.penalize(chat_id, e.retry_after)
+            raise
+
+
+RATE_LIMITER = RateLimiter()
@@ -1,36 +1,56 @@
 import asyncio
-import json
-from datetime import datetime
+import os
+import random
+import socket
+import time
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
 from typing import Iterable
 
 from aiogram import Bot
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     InputMediaPhoto,
     InputMediaVideo,
     InputMediaDocument,
-    InputMediaAnimation, MessageEntity,
+    InputMediaAnimation,
 )
 
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
+from database.deadlines import SCHEDULER_DEADLINES
 from database.engine import session_maker
-from database.models import PostTarget, TargetState, MediaType, PostEventType, PostEvent
+from database.models import Post, PostTarget, TargetState, MediaType, PostEventType, PostEvent
 from database.orm_query import (
     orm_pick_targets_to_publish,
-    orm_get_target_full,
+    orm_claim_targets_to_send,
+    orm_get_targets_full,
     orm_mark_target_sent,
     orm_mark_target_failed,
+    orm_mark_target_retry,
+    orm_renew_target_lease,
+    orm_defer_targets,
     orm_pick_targets_to_autodelete,
-    orm_mark_target_autodeleted,
+    orm_get_upcoming_deadlines,
+    orm_mark_targets_autodeleted,
     orm_log_post_event,
+    orm_log_post_events,
 )
 import logging
 
 from kbds.callbacks import ReactionCD
+from middlewares.rate_limit import RATE_LIMITER
+from utils.entities_html import entities_to_html
+from utils.reaction_aggregator import REACTION_AGGREGATOR, reaction_label
+from utils.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
@@ -80,337 +100,692 @@ def _media_to_input(media, caption: str | None, is_first: bool, show_caption_abo
     return None
 
 
-async def _send_target(bot: Bot, t_full: PostTarget) -> list[int]:
+# Методы отправки одиночного медиа по типу
+_SINGLE_MEDIA_METHODS = {
+    MediaType.photo: ("send_photo", "photo"),
+    MediaType.video: ("send_video", "video"),
+    MediaType.document: ("send_document", "document"),
+    MediaType.gif: ("send_animation", "animation"),
+    MediaType.voice: ("send_voice", "voice"),
+}
+
+
+@dataclass
+class RenderedPost:
     """
-    Возвращает список message_id отправленных сообщений (для альбома их несколько).
+    Готовый к отправке пост: всё, что не зависит от канала, посчитано один раз на версию поста
+    (HTML, клавиатура, InputMedia). Канал и reply подставляются при отправке.
     """
-    # В начале _send_target добавь:
-    bot_info = await bot.get_me()
-    print(f"Bot has premium: {bot_info.is_premium}")
-    post = t_full.post
-    if post.is_repost and post.source_chat_id and post.source_message_id:
-        try:
-            msg = await bot.forward_message(
-                chat_id=t_full.channel_id,
-                from_chat_id=post.source_chat_id,
-                message_id=post.source_message_id,
-                disable_notification=bool(post.silent),
-                protect_content=bool(post.protected),
-            )
+    post_id: int
+    version: int
+    method: str
+    kwargs: dict
+    pinned: bool
+    # HTML текста поста (подпись / текст сообщения) — его же показывают превью
+    html_text: str = ""
+    parse_mode: str | None = None
+    # альбом не поддерживает inline kb — кнопки уходят отдельным сообщением
+    album_kb: InlineKeyboardMarkup | None = None
+    # репост: сначала пробуем переслать оригинал
+    forward_from: tuple[int, int] | None = None
+
+    @property
+    def keyboard(self) -> InlineKeyboardMarkup | None:
+        """Inline-клавиатура поста (у альбома — клавиатура отдельного сообщения)."""
+        return self.album_kb if self.method == "send_media_group" else self.kwargs.get("reply_markup")
+
+    @property
+    def copyable(self) -> bool:
+        """Можно ли разослать копией первого отправленного сообщения (copy_message)."""
+        return (
+            self.method != "send_media_group"
+            and self.forward_from is None
+            and not self.kwargs.get("protect_content")
+        )
 
 
-            # Закрепление
-            if bool(post.pinned):
-                try:
-                    await bot.pin_chat_message(
-                        chat_id=t_full.channel_id,
-                        message_id=msg.message_id,
-                        disable_notification=True,
-                    )
-                except TelegramBadRequest:
-                    pass
+@dataclass
+class SentPost:
+    """Результат отправки: все message_id публикации и сообщение с inline-клавиатурой."""
+    message_ids: list[int]
+    keyboard_message_id: int | None = None
 
-            return [msg.message_id]
 
-        except TelegramBadRequest as e:
-            print(f"[REPOST] Forward failed: {e}, using normal send")
+@dataclass
+class FanOut:
+    """Рассылка одной версии поста по всем каналам прохода."""
+    rendered: RenderedPost
+    # (chat_id, message_id) первой успешной отправки — источник для copy_message
+    source: tuple[int, int] | None = None
 
-    kb = _build_post_kb(post)
+
+def _render_post(post: Post) -> RenderedPost:
+    """
+    Собирает параметры отправки поста (без сетевых запросов).
+    Кнопки реакций не включаются: счётчики меняются без смены версии поста,
+    их добавляет render_post_cached().
+    """
+    kb = _build_post_kb(post, reactions=False)
 
     text = post.text or ""
+    html_text, parse_mode = _convert_to_html_with_emoji(text, post.text_entities)
     text_position = getattr(post, 'text_position', 'bottom') or 'bottom'
     show_caption_above = (text_position == "top")
-    sent_ids = []
-    reply_to_message_id = None
-    if t_full.reply:
-        reply_to_message_id = t_full.reply.reply_to_message_id
+    common = {
+        "disable_notification": bool(post.silent),
+        "protect_content": bool(post.protected),
+    }
+    forward_from = None
+    if post.is_repost and post.source_chat_id and post.source_message_id:
+        forward_from = (post.source_chat_id, post.source_message_id)
+
+    def _rendered(method: str, album_kb: InlineKeyboardMarkup | None = None, **kwargs) -> RenderedPost:
+        return RenderedPost(
+            post_id=post.id,
+            version=post.version,
+            method=method,
+            kwargs={**kwargs, **common},
+            pinned=bool(post.pinned),
+            html_text=html_text,
+            parse_mode=parse_mode,
+            album_kb=album_kb,
+            forward_from=forward_from,
+        )
 
+    # 1) АЛЬБОМ
     if post.media and len(post.media) > 1:
         media_sorted = sorted(post.media, key=lambda m: int(m.order_index))
 
         input_media = []
         for i, m in enumerate(media_sorted):
-            cap = text if i == 0 and text else None
+            cap = html_text if i == 0 and html_text else None
             im = _media_to_input(m, caption=cap, is_first=(i == 0), show_caption_above=show_caption_above)
             if im is not None:
                 input_media.append(im)
 
-        msgs = await bot.send_media_group(
-            chat_id=t_full.channel_id,
-            media=input_media,
-            disable_notification=bool(post.silent),
-            protect_content=bool(post.protected),
-            reply_to_message_id=reply_to_message_id,
-        )
-        sent_ids = [m.message_id for m in msgs]
-
-        # Закрепление
-        if bool(post.pinned) and sent_ids:
-            try:
-                await bot.pin_chat_message(
-                    chat_id=t_full.channel_id,
-                    message_id=sent_ids[0],
-                    disable_notification=True,
-                )
-            except TelegramBadRequest:
-                pass
+        return _rendered("send_media_group", album_kb=kb, media=input_media)
 
-        # URL-кнопки отдельным сообщением (media_group не поддерживает inline kb)
-        if kb is not None:
-            m2 = await bot.send_message(
-                chat_id=t_full.channel_id,
-                text="​",  # Zero-width space
-                reply_markup=kb,
-                disable_notification=bool(post.silent),
-                protect_content=bool(post.protected),
-            )
-            sent_ids.append(m2.message_id)
-
-        return sent_ids
-
-        # ==========================================================================
-        # 2) ОДИН МЕДИА-ФАЙЛ
-        # ==========================================================================
+    # 2) ОДИН МЕДИА-ФАЙЛ
     if post.media and len(post.media) == 1:
         m = post.media[0]
-        mt = m.media_type
-        caption = text if text else None
-        html_text, parse_mode = _convert_to_html_with_emoji(text, post.text_entities)
-        сaption = html_text or caption
-
-
-        if mt == MediaType.photo:
-            msg = await bot.send_photo(
-                t_full.channel_id,
-                photo=m.file_id,
-                caption=html_text or caption,
-                parse_mode=parse_mode,
-                show_caption_above_media=show_caption_above,  # <-- Текст сверху!
-                reply_markup=kb,
-                disable_notification=bool(post.silent),
-                protect_content=bool(post.protected),
-                reply_to_message_id=reply_to_message_id,
-            )
-        elif mt == MediaType.video:
-            msg = await bot.send_video(
-                t_full.channel_id,
-                video=m.file_id,
-                caption=html_text or caption,
-                show_caption_above_media=show_caption_above,  # <-- Текст сверху!
-                reply_markup=kb,
-                disable_notification=bool(post.silent),
-                protect_content=bool(post.protected),
-                reply_to_message_id=reply_to_message_id,
-            )
-        elif mt == MediaType.document:
-            msg = await bot.send_document(
-                t_full.channel_id,
-                document=m.file_id,
-                caption=html_text or caption,
-                reply_markup=kb,
-                disable_notification=bool(post.silent),
-                protect_content=bool(post.protected),
-                reply_to_message_id=reply_to_message_id,
-            )
-        elif mt == MediaType.gif:
-            msg = await bot.send_animation(
-                t_full.channel_id,
-                animation=m.file_id,
-                caption=html_text or caption,
-                show_caption_above_media=show_caption_above,  # <-- Текст сверху!
-                reply_markup=kb,
-                disable_notification=bool(post.silent),
-                protect_content=bool(post.protected),
-                reply_to_message_id=reply_to_message_id,
+        method, field_name = _SINGLE_MEDIA_METHODS.get(m.media_type, ("send_document", "document"))
+        kwargs = {field_name: m.file_id, "caption": html_text or None, "parse_mode": parse_mode, "reply_markup": kb}
+        if m.media_type in (MediaType.photo, MediaType.video, MediaType.gif):
+            kwargs["show_caption_above_media"] = show_caption_above  # текст сверху
+        return _rendered(method, **kwargs)
 
-            )
-        elif mt == MediaType.voice:
-            msg = await bot.send_voice(
-                t_full.channel_id,
-                voice=m.file_id,
-                caption=html_text or caption,
-                reply_markup=kb,
-                disable_notification=bool(post.silent),
-                protect_content=bool(post.protected),
-                reply_to_message_id=reply_to_message_id,
+    # 3) ТОЛЬКО ТЕКСТ
+    return _rendered("send_message", text=html_text or text or "​", parse_mode=parse_mode, reply_markup=kb)
 
-            )
-        else:
-            msg = await bot.send_document(
-                t_full.channel_id,
-                document=m.file_id,
-                caption=caption,
-                reply_markup=kb,
-                disable_notification=bool(post.silent),
-                protect_content=bool(post.protected),
-                reply_to_message_id=reply_to_message_id,
 
-            )
+# (post_id, version) -> RenderedPost без кнопок реакций.
+# Любое изменение содержимого поста увеличивает Post.version, поэтому старые записи
+# просто перестают запрашиваться и вытесняются по LRU/TTL.
+RENDER_CACHE: TTLCache[tuple[int, int], RenderedPost] = TTLCache(maxsize=2048, ttl=3600)
 
-        sent_ids.append(msg.message_id)
 
-        # Закрепление
-        if bool(post.pinned):
-            try:
-                await bot.pin_chat_message(
-                    chat_id=t_full.channel_id,
-                    message_id=msg.message_id,
-                    disable_notification=True,
-                )
-            except TelegramBadRequest:
-                pass
+def render_post_cached(post: Post) -> RenderedPost:
+    """
+    RenderedPost для текущей версии поста: HTML, InputMedia и URL/hidden-кнопки берутся
+    из RENDER_CACHE, актуальные кнопки реакций дописываются при каждом вызове.
+    """
+    key = (post.id, post.version)
+    rendered = RENDER_CACHE.get(key)
+    if rendered is None:
+        rendered = _render_post(post)
+        RENDER_CACHE.set(key, rendered)
+    return _with_reaction_rows(rendered, _build_reaction_rows(post))
 
-        return sent_ids
 
-        # ==========================================================================
-        # 3) ТОЛЬКО ТЕКСТ
-        # ==========================================================================
-    html_text, parse_mode = _convert_to_html_with_emoji(text, post.text_entities)
-    print(f"=== КОНВЕРТАЦИЯ ===")
-    print(f"HTML: {html_text}")
-
-    # Прямо перед отправкой:
-    final_text = html_text or text or "​"
-    print(f"=== ОТПРАВКА ===")
-    print(f"final_text: {final_text}")
-    print(f"parse_mode: {parse_mode}")
-    msg = await bot.send_message(
-        chat_id=t_full.channel_id,
-        text=final_text or "​",
-        parse_mode=parse_mode,
-        reply_markup=kb,
-        disable_notification=bool(post.silent),
-        protect_content=bool(post.protected),
+def _with_reaction_rows(rendered: RenderedPost, rows: list[list[InlineKeyboardButton]]) -> RenderedPost:
+    """Копия rendered с дописанными рядами реакций (закэшированный объект не меняется)."""
+    if not rows:
+        return rendered
+
+    def _extend(kb: InlineKeyboardMarkup | None) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[*(kb.inline_keyboard if kb else []), *rows])
+
+    if rendered.method == "send_media_group":
+        return replace(rendered, album_kb=_extend(rendered.album_kb))
+    return replace(rendered, kwargs={**rendered.kwargs, "reply_markup": _extend(rendered.kwargs.get("reply_markup"))})
+
+
+async def _pin_message(bot: Bot, chat_id: int, message_id: int) -> None:
+    # пост уже опубликован: ошибка закрепления не должна приводить к повторной отправке
+    try:
+        await bot.pin_chat_message(chat_id=chat_id, message_id=message_id, disable_notification=True)
+    except TelegramBadRequest:
+        pass
+    except Exception as e:
+        logger.warning(f"[publish] pin {chat_id}/{message_id} failed: {e}")
+
+
+async def _dispatch_rendered(
+        bot: Bot,
+        rendered: RenderedPost,
+        chat_id: int,
+        reply_to_message_id: int | None,
+) -> SentPost:
+    result = await getattr(bot, rendered.method)(
+        chat_id=chat_id,
         reply_to_message_id=reply_to_message_id,
+        **rendered.kwargs,
     )
-    sent_ids.append(msg.message_id)
-    print(f"=== ОТПРАВКА ПОСТА ===")
-    print(f"post.text_entities: {post.text_entities}")
-    entities = _parse_entities(post.text_entities)
-    print(f"parsed entities: {entities}")
-    # Добавь тестовый код:
-    test_text = 'Тест <tg-emoji emoji-id="5368324170671202286">✅</tg-emoji> premium emoji'
-    await bot.send_message(
-        chat_id=t_full.channel_id,
-        text=test_text,
-        parse_mode="HTML"
-    )
+    sent_ids = [m.message_id for m in result] if isinstance(result, list) else [result.message_id]
+    if rendered.pinned and sent_ids:
+        await _pin_message(bot, chat_id, sent_ids[0])
+
+    keyboard_message_id = sent_ids[0] if sent_ids and rendered.kwargs.get("reply_markup") else None
+    if rendered.album_kb is not None:
+        # альбом уже в канале: если сообщение с кнопками не ушло, повтор отправил бы
+        # альбом второй раз — записываем то, что отправлено, без клавиатуры
+        try:
+            m2 = await bot.send_message(
+                chat_id=chat_id,
+                text="​",  # Zero-width space
+                reply_markup=rendered.album_kb,
+                disable_notification=rendered.kwargs["disable_notification"],
+                protect_content=rendered.kwargs["protect_content"],
+            )
+        except Exception as e:
+            logger.warning(f"[publish] album {chat_id}/{sent_ids[0]} sent, keyboard message failed: {e}")
+        else:
+            sent_ids.append(m2.message_id)
+            keyboard_message_id = m2.message_id
+    return SentPost(message_ids=sent_ids, keyboard_message_id=keyboard_message_id)
+
+
+async def _copy_rendered(
+        bot: Bot,
+        fanout: FanOut,
+        chat_id: int,
+        reply_to_message_id: int | None,
+) -> SentPost | None:
+    """Копия уже отправленного сообщения; None — источник недоступен (удалён и т.п.)."""
+    rendered = fanout.rendered
+    from_chat_id, message_id = fanout.source
+    kwargs = {
+        k: v for k, v in rendered.kwargs.items()
+        if k in ("reply_markup", "disable_notification", "protect_content", "show_caption_above_media")
+    }
+    try:
+        res = await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=from_chat_id,
+            message_id=message_id,
+            reply_to_message_id=reply_to_message_id,
+            **kwargs,
+        )
+    except TelegramBadRequest as e:
+        logger.info(f"[publish] copy from {from_chat_id}/{message_id} failed: {e}, using normal send")
+        return None
+    if rendered.pinned:
+        await _pin_message(bot, chat_id, res.message_id)
+    keyboard_message_id = res.message_id if kwargs.get("reply_markup") else None
+    return SentPost(message_ids=[res.message_id], keyboard_message_id=keyboard_message_id)
+
+
+async def _send_target(
+        bot: Bot,
+        t_full: PostTarget,
+        fanout: FanOut | None = None,
+        *,
+        copy: bool = False,
+) -> SentPost:
+    """
+    Возвращает message_id отправленных сообщений (для альбома их несколько).
+    fanout — общий для всех каналов рендер этой версии поста; copy=True — рассылать
+    копией первого успешно отправленного сообщения (copy_message), где это возможно.
+    """
+    if fanout is None:
+        fanout = FanOut(rendered=render_post_cached(t_full.post))
+    rendered = fanout.rendered
 
-    if bool(post.pinned):
+    if rendered.forward_from is not None:
+        from_chat_id, message_id = rendered.forward_from
         try:
-            await bot.pin_chat_message(
+            msg = await bot.forward_message(
                 chat_id=t_full.channel_id,
-                message_id=msg.message_id,
-                disable_notification=True,
+                from_chat_id=from_chat_id,
+                message_id=message_id,
+                disable_notification=rendered.kwargs["disable_notification"],
+                protect_content=rendered.kwargs["protect_content"],
             )
-        except TelegramBadRequest:
-            pass
+            if rendered.pinned:
+                await _pin_message(bot, t_full.channel_id, msg.message_id)
+            return SentPost(message_ids=[msg.message_id])
+        except TelegramBadRequest as e:
+            logger.info(f"[REPOST] Forward failed: {e}, using normal send")
 
-    return sent_ids
+    reply_to_message_id = t_full.reply.reply_to_message_id if t_full.reply else None
+
+    if copy and rendered.copyable and fanout.source is not None:
+        sent = await _copy_rendered(bot, fanout, t_full.channel_id, reply_to_message_id)
+        if sent is not None:
+            return sent
+
+    sent = await _dispatch_rendered(bot, rendered, t_full.channel_id, reply_to_message_id)
+    if fanout.source is None and sent.message_ids:
+        fanout.source = (t_full.channel_id, sent.message_ids[0])
+    return sent
 
-async def _pick_queued(session: AsyncSession, limit: int = 20) -> list[PostTarget]:
-    q = (
-        select(PostTarget)
-        .where(PostTarget.state == TargetState.queued)
-        .order_by(PostTarget.publish_at.asc().nullsfirst(), PostTarget.id.asc())
-        .limit(limit)
-    )
-    res = await session.execute(q)
-    return list(res.scalars().all())
 
+# Повторы временных ошибок отправки
+MAX_PUBLISH_ATTEMPTS = 8
+RETRY_BASE_DELAY = 5.0  # секунд, удваивается с каждой попыткой
+RETRY_MAX_DELAY = 30 * 60.0
 
-async def _get_last_sent_ids(session: AsyncSession, target_id: int) -> list[int] | None:
+TRANSIENT_ERRORS = (TelegramServerError, TelegramNetworkError, asyncio.TimeoutError, ConnectionError)
+
+
+def _retry_delay(error: Exception, attempts: int) -> float | None:
+    """
+    Через сколько секунд повторить отправку; None — ошибка постоянная (target -> failed).
+    - TelegramRetryAfter: ждём ровно retry_after (+ немного, чтобы не прийти всем сразу);
+    - 5xx/сеть: экспоненциальный backoff с jitter, не больше MAX_PUBLISH_ATTEMPTS попыток.
+    """
+    if isinstance(error, TelegramRetryAfter):
+        return float(error.retry_after) + random.uniform(0.0, 1.0)
+    if isinstance(error, TRANSIENT_ERRORS) and attempts + 1 < MAX_PUBLISH_ATTEMPTS:
+        backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempts)
+        return random.uniform(backoff / 2, backoff)
+    return None
+
+
+# Аренда продлевается перед отправкой каждого target, поэтому ей достаточно пережить
+# одну отправку (с ожиданием в rate limiter), а не весь захваченный батч
+LEASE_DURATION = timedelta(minutes=15)
+
+
+def _make_worker_id() -> str:
+    """Идентификатор процесса планировщика для аренды targets (lease_owner)."""
+    return f"{socket.gethostname()}:{os.getpid()}"[:64]
+
+
+async def _get_last_sent_ids(session: AsyncSession, target_ids: Iterable[int]) -> dict[int, list[int]]:
+    """
+    message_id последней отправки каждого target (из событий sent) одним запросом.
+    Нужно только для targets, отправленных до появления PostTarget.sent_message_ids.
+    """
     q = (
-        select(PostEvent)
-        .where(PostEvent.target_id == target_id)
+        select(PostEvent.target_id, PostEvent.payload)
+        .where(PostEvent.target_id.in_(list(target_ids)))
         .where(PostEvent.event_type == PostEventType.sent)
-        .order_by(PostEvent.created_at.desc())
-        .limit(1)
+        .order_by(PostEvent.target_id, PostEvent.created_at.desc())
+        .distinct(PostEvent.target_id)
     )
     res = await session.execute(q)
-    ev = res.scalar_one_or_none()
-    if not ev or not ev.payload:
-        return None
-    ids = ev.payload.get("sent_message_ids")
-    if isinstance(ids, list) and all(isinstance(x, int) for x in ids):
-        return ids
-    return None
+    out: dict[int, list[int]] = {}
+    for target_id, payload in res:
+        ids = (payload or {}).get("sent_message_ids")
+        if isinstance(ids, list) and ids and all(isinstance(x, int) for x in ids):
+            out[target_id] = ids
+    return out
+
+
+@dataclass
+class PublishStats:
+    """Счётчики одного прохода планировщика (для лога пропускной способности)."""
+    sent: int = 0
+    retried: int = 0
+    failed: int = 0
+    # аренду перехватил другой процесс — target отправит он
+    lost: int = 0
+
+
+async def _renew_lease(
+        session_maker: async_sessionmaker[AsyncSession],
+        t_full: PostTarget,
+        owner: str,
+) -> bool:
+    async with session_maker() as session:
+        renewed = await orm_renew_target_lease(
+            session, target_id=t_full.id, owner=owner, lease_for=LEASE_DURATION,
+        )
+        await session.commit()
+    if not renewed:
+        logger.warning(f"[publish] target={t_full.id} channel={t_full.channel_id}: lease lost, skipping")
+    return renewed
+
+
+async def _record_sent(
+        session_maker: async_sessionmaker[AsyncSession],
+        t_full: PostTarget,
+        sent: SentPost,
+        owner: str,
+) -> None:
+    async with session_maker() as session:
+        owned = await orm_mark_target_sent(
+            session,
+            target_id=t_full.id,
+            sent_message_id=sent.message_ids[0],
+            sent_message_ids=sent.message_ids,
+            keyboard_message_id=sent.keyboard_message_id,
+            owner=owner,
+        )
+        if not owned:
+            logger.warning(f"[publish] target={t_full.id}: lease lost before recording the send")
+            return
+        await orm_log_post_event(
+            session,
+            post_id=t_full.post_id,
+            target_id=t_full.id,
+            actor_user_id=None,
+            event_type=PostEventType.sent,
+            payload={"sent_message_ids": sent.message_ids},
+        )
+        await session.commit()
+
+
+async def _record_retry(
+        session_maker: async_sessionmaker[AsyncSession],
+        t_full: PostTarget,
+        error: Exception,
+        retry_at: datetime,
+        owner: str,
+) -> None:
+    logger.info(
+        f"[publish] target={t_full.id} channel={t_full.channel_id} retry at {retry_at} "
+        f"(attempt {(t_full.attempts or 0) + 1}): {error}"
+    )
+    async with session_maker() as session:
+        await orm_mark_target_retry(
+            session, target_id=t_full.id, error=str(error), next_attempt_at=retry_at, owner=owner,
+        )
+        await session.commit()
+
+
+async def _record_deferred(
+        session_maker: async_sessionmaker[AsyncSession],
+        targets: list[PostTarget],
+        retry_at: datetime,
+        owner: str,
+) -> None:
+    async with session_maker() as session:
+        await orm_defer_targets(
+            session, target_ids=[t.id for t in targets], owner=owner, next_attempt_at=retry_at,
+        )
+        await session.commit()
+
+
+async def _record_failed(
+        session_maker: async_sessionmaker[AsyncSession],
+        t_full: PostTarget,
+        error: Exception,
+        owner: str,
+) -> None:
+    logger.warning(f"[publish] target={t_full.id} channel={t_full.channel_id} error={error}")
+    async with session_maker() as session:
+        if not await orm_mark_target_failed(session, target_id=t_full.id, error=str(error), owner=owner):
+            return
+        await orm_log_post_event(
+            session,
+            post_id=t_full.post_id,
+            target_id=t_full.id,
+            actor_user_id=None,
+            event_type=PostEventType.failed,
+            payload={"error": str(error)},
+        )
+        await session.commit()
+
+
+async def _publish_channel_queue(
+        bot: Bot,
+        session_maker: async_sessionmaker[AsyncSession],
+        targets: list[PostTarget],
+        stats: PublishStats,
+        fanouts: dict[tuple[int, int], FanOut],
+        *,
+        owner: str,
+        copy: bool,
+) -> None:
+    """
+    Публикует targets одного канала строго по очереди (порядок внутри канала сохраняется).
+    Результат каждого target сразу фиксируется своей короткой транзакцией —
+    соединение с БД не держится во время запросов к Telegram.
+    Перед отправкой аренда target продлевается; если её перехватил другой процесс
+    (очередь канала шла дольше аренды), target пропускается — его отправит тот процесс.
+    """
+    for i, t_full in enumerate(targets):
+        if not await _renew_lease(session_maker, t_full, owner):
+            stats.lost += 1
+            continue
+        try:
+            fanout = fanouts[(t_full.post.id, t_full.post.version)]
+            sent = await _send_target(bot, t_full, fanout, copy=copy)
+            if not sent.message_ids:
+                raise RuntimeError("nothing was sent")
+        except Exception as e:
+            delay = _retry_delay(e, t_full.attempts or 0)
+            if delay is None:
+                stats.failed += 1
+                await _record_failed(session_maker, t_full, e, owner)
+                continue
+
+            # временная ошибка: остальные посты канала откладываем на то же время,
+            # чтобы после повтора они ушли в прежнем порядке; попытка засчитывается
+            # только упавшему target
+            retry_at = datetime.utcnow() + timedelta(seconds=delay)
+            stats.retried += 1
+            await _record_retry(session_maker, t_full, e, retry_at, owner)
+            await _record_deferred(session_maker, targets[i + 1:], retry_at, owner)
+            return
+
+        stats.sent += 1
+        await _record_sent(session_maker, t_full, sent, owner)
+
+
+async def _publish_batch(
+        bot: Bot,
+        session_maker: async_sessionmaker[AsyncSession],
+        targets: list[PostTarget],
+        *,
+        owner: str,
+        concurrency: int,
+        copy: bool = False,
+) -> PublishStats:
+    """
+    Пул воркеров: разные каналы публикуются параллельно (не больше concurrency каналов сразу),
+    внутри одного канала — последовательно, в порядке очереди.
+    Каждая версия поста рендерится один раз на проход и рассылается во все свои каналы.
+    """
+    by_channel: dict[int, list[PostTarget]] = {}
+    fanouts: dict[tuple[int, int], FanOut] = {}
+    for t in targets:
+        by_channel.setdefault(t.channel_id, []).append(t)
+        key = (t.post.id, t.post.version)
+        if key not in fanouts:
+            fanouts[key] = FanOut(rendered=render_post_cached(t.post))
+
+    sem = asyncio.Semaphore(max(1, concurrency))
+    stats = PublishStats()
+
+    async def _worker(channel_targets: list[PostTarget]):
+        async with sem:
+            await _publish_channel_queue(
+                bot, session_maker, channel_targets, stats, fanouts, owner=owner, copy=copy,
+            )
+
+    await asyncio.gather(*(_worker(items) for items in by_channel.values()))
+    return stats
+
 
+# deleteMessages принимает не больше 100 id за вызов
+DELETE_MESSAGES_CHUNK = 100
 
 
-async def scheduler_loop(bot: Bot, session_maker: async_sessionmaker[AsyncSession], *, tick: float = 2.0):
+async def _delete_channel_messages(bot: Bot, channel_id: int, ids: list[int]) -> bool:
     """
-    1) scheduled->queued по publish_at
-    2) отправка queued
-    3) автоудаление по auto_delete_at
+    Удаляет сообщения канала пачками через deleteMessages.
+    False — временная ошибка, targets канала останутся в аренде и будут повторены позже.
     """
-    while True:
+    for i in range(0, len(ids), DELETE_MESSAGES_CHUNK):
+        chunk = ids[i:i + DELETE_MESSAGES_CHUNK]
         try:
-            async with session_maker() as session:
-                # 1) scheduled -> queued
-                await orm_pick_targets_to_publish(session, limit=50, now=datetime.utcnow())
+            await bot.delete_messages(chat_id=channel_id, message_ids=chunk)
+        except TelegramBadRequest as e:
+            # если уже удалено/нет прав — не валим весь воркер
+            logger.info(f"[autodelete] channel={channel_id}: {e}")
+        except Exception as e:
+            logger.warning(f"[autodelete] channel={channel_id} failed, will retry: {e}")
+            return False
+    return True
+
+
+async def _autodelete_batch(
+        bot: Bot,
+        session_maker: async_sessionmaker[AsyncSession],
+        targets: list[PostTarget],
+        ids_by_target: dict[int, list[int]],
+        *,
+        concurrency: int,
+) -> None:
+    """Автоудаление пачкой: по каналам параллельно, внутри канала — deleteMessages по 100 id."""
+    by_channel: dict[int, list[PostTarget]] = {}
+    for t in targets:
+        by_channel.setdefault(t.channel_id, []).append(t)
+
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def _worker(channel_id: int, channel_targets: list[PostTarget]) -> list[PostTarget]:
+        ids = [mid for t in channel_targets for mid in ids_by_target[t.id]]
+        async with sem:
+            ok = await _delete_channel_messages(bot, channel_id, ids)
+        return channel_targets if ok else []
+
+    chunks = await asyncio.gather(*(_worker(ch, items) for ch, items in by_channel.items()))
+    done = [t for chunk in chunks for t in chunk]
+    if not done:
+        return
+
+    async with session_maker() as session:
+        await orm_mark_targets_autodeleted(session, target_ids=[t.id for t in done])
+        await orm_log_post_events(
+            session,
+            event_type=PostEventType.auto_deleted,
+            events=[(t.post_id, t.id, {"deleted_message_ids": ids_by_target[t.id]}) for t in done],
+        )
+        await session.commit()
+
+
+async def _scheduler_tick(
+        bot: Bot,
+        session_maker: async_sessionmaker[AsyncSession],
+        *,
+        worker_id: str,
+        batch_size: int,
+        concurrency: int,
+        fanout_copy: bool = False,
+        autodelete_batch_size: int = 50,
+) -> bool:
+    """
+    Один проход планировщика: claim (короткая транзакция) -> отправка без соединения с БД ->
+    запись результата каждого target отдельной короткой транзакцией.
+    Возвращает True, если какая-то из выборок упёрлась в лимит (работа ещё осталась).
+    """
+    # 1) claim: scheduled -> queued, аренда queued и targets для автоудаления
+    async with session_maker() as session:
+        now = datetime.utcnow()
+        picked = await orm_pick_targets_to_publish(session, limit=batch_size, now=now)
+        queued = await orm_claim_targets_to_send(
+            session, owner=worker_id, limit=batch_size, lease_for=LEASE_DURATION, now=now,
+        )
+        targets_full = await orm_get_targets_full(session, target_ids=[t.id for t in queued])
 
-                # 2) publish queued
-                queued = await _pick_queued(session, limit=20)
-                for t in queued:
-                    try:
-                        t_full = await orm_get_target_full(session, target_id=t.id)
-                        sent_ids = await _send_target(bot, t_full)
-
-                        await orm_mark_target_sent(session, target_id=t.id, sent_message_id=sent_ids[0])
-                        await orm_log_post_event(
-                            session,
-                            post_id=t_full.post_id,
-                            target_id=t_full.id,
-                            actor_user_id=None,
-                            event_type=PostEventType.sent,
-                            payload={"sent_message_ids": sent_ids},
-                        )
-                    except Exception as e:
-                        await orm_mark_target_failed(session, target_id=t.id, error=str(e))
-                        await orm_log_post_event(
-                            session,
-                            post_id=t.post_id,
-                            target_id=t.id,
-                            actor_user_id=None,
-                            event_type=PostEventType.failed,
-                            payload={"error": str(e)},
-                        )
+        to_del = await orm_pick_targets_to_autodelete(
+            session, limit=autodelete_batch_size, now=now, owner=worker_id, lease_for=LEASE_DURATION,
+        )
+        legacy = [t.id for t in to_del if t.sent_message_ids is None]
+        last_sent = await _get_last_sent_ids(session, legacy) if legacy else {}
+        to_del_ids = {
+            t.id: t.sent_message_ids or last_sent.get(t.id) or ([t.sent_message_id] if t.sent_message_id else [])
+            for t in to_del
+        }
+        await session.commit()
+
+    # 2) publish queued
+    if targets_full:
+        started = time.monotonic()
+        stats = await _publish_batch(
+            bot, session_maker, targets_full, owner=worker_id, concurrency=concurrency, copy=fanout_copy,
+        )
+        elapsed = time.monotonic() - started
+
+        channels = len({t.channel_id for t in targets_full})
+        limits = RATE_LIMITER.stats()
+        logger.info(
+            f"[publish] tick: sent={stats.sent} retry={stats.retried} failed={stats.failed} lost={stats.lost} "
+            f"channels={channels} in {elapsed:.2f}s ({len(targets_full) / max(elapsed, 1e-6):.1f} targets/s), "
+            f"rate-limit wait: global={limits['global_wait']:.2f}s max_chat={limits['max_chat_wait']:.2f}s"
+        )
 
-                # 3) auto-delete
-                to_del = await orm_pick_targets_to_autodelete(session, limit=50, now=datetime.utcnow())
-                for t in to_del:
-                    ids = await _get_last_sent_ids(session, t.id) or ([t.sent_message_id] if t.sent_message_id else [])
-                    for mid in ids:
-                        try:
-                            await bot.delete_message(chat_id=t.channel_id, message_id=mid)
-                        except TelegramBadRequest as e:
-                            # если уже удалено/нет прав — не валим весь воркер
-                            pass
-
-                    await orm_mark_target_autodeleted(session, target_id=t.id)
-                    await orm_log_post_event(
-                        session,
-                        post_id=t.post_id,
-                        target_id=t.id,
-                        actor_user_id=None,
-                        event_type=PostEventType.auto_deleted,
-                        payload={"deleted_message_ids": ids},
-                    )
+    # 3) auto-delete
+    if to_del:
+        await _autodelete_batch(bot, session_maker, to_del, to_del_ids, concurrency=concurrency)
 
-                await session.commit()
+    return (
+        len(picked) >= batch_size
+        or len(queued) >= batch_size
+        or len(to_del) >= autodelete_batch_size
+    )
 
+
+async def scheduler_loop(
+        bot: Bot,
+        session_maker: async_sessionmaker[AsyncSession],
+        *,
+        max_idle: float = 60.0,
+        error_backoff: float = 5.0,
+        batch_size: int = 100,
+        concurrency: int = 10,
+        fanout_copy: bool = False,
+        worker_id: str | None = None,
+):
+    """
+    1) scheduled->queued по publish_at
+    2) отправка queued (параллельно по каналам, см. _publish_batch);
+       fanout_copy=True — рассылать пост по остальным каналам копией первой отправки
+    3) автоудаление по auto_delete_at
+
+    Между проходами планировщик не опрашивает БД по таймеру, а спит до ближайшего
+    дедлайна из SCHEDULER_DEADLINES (куча грузится из индексов после каждого прохода,
+    новые дедлайны приходят через signal_deadline при планировании/переносе).
+    max_idle — страховочный интервал для изменений, сделанных в обход ORM-функций.
+
+    Targets захватываются арендой с worker_id, поэтому можно запускать несколько
+    процессов планировщика на одну БД — каждый target отправит только один из них.
+    """
+    worker_id = worker_id or _make_worker_id()
+    while True:
+        try:
+            has_more = await _scheduler_tick(
+                bot,
+                session_maker,
+                worker_id=worker_id,
+                batch_size=batch_size,
+                concurrency=concurrency,
+                fanout_copy=fanout_copy,
+            )
+            if has_more:
+                continue
+
+            SCHEDULER_DEADLINES.clear()
+            async with session_maker() as session:
+                SCHEDULER_DEADLINES.extend(await orm_get_upcoming_deadlines(session))
         except Exception as e:
-            print(f"[publish] target={t.id} channel={t.channel_id} error={e}")
+            logger.exception(f"[publish] scheduler tick failed: {e}")
+            await asyncio.sleep(error_backoff)
+            continue
 
-        await asyncio.sleep(tick)
+        await SCHEDULER_DEADLINES.sleep(max_idle)
 
 
-def _build_post_kb(post) -> InlineKeyboardMarkup | None:
+def _build_post_kb(post, *, reactions: bool = True) -> InlineKeyboardMarkup | None:
     """
     Строит клавиатуру поста:
     1. URL-кнопки пользователя (если есть)
     2. Кнопка скрытого продолжения (если есть)
+    3. Кнопки реакций со счётчиками (если reactions=True)
     """
     kb_rows = []
 
@@ -442,30 +817,38 @@ def _build_post_kb(post) -> InlineKeyboardMarkup | None:
         ])
 
 
-        # 3. Кнопки реакций
-    if hasattr(post, 'reaction_buttons') and post.reaction_buttons:
-        reaction_rows_map: dict[int, list] = {}
-        for btn in post.reaction_buttons:
-            if btn.row not in reaction_rows_map:
-                reaction_rows_map[btn.row] = []
-            reaction_rows_map[btn.row].append(btn)
-
-        for row_idx in sorted(reaction_rows_map.keys()):
-            sorted_btns = sorted(reaction_rows_map[row_idx], key=lambda b: b.position)
-            reaction_row = []
-            for btn in sorted_btns:
-                count_str = f" {btn.click_count}" if btn.click_count > 0 else ""
-                reaction_row.append(
-                    InlineKeyboardButton(
-                        text=f"{btn.emoji}{count_str}",
-                        callback_data=ReactionCD(button_id=btn.id).pack()
-                    )
-                )
-            if reaction_row:
-                kb_rows.append(reaction_row)
+    # 3. Кнопки реакций
+    if reactions:
+        kb_rows.extend(_build_reaction_rows(post))
 
     return InlineKeyboardMarkup(inline_keyboard=kb_rows) if kb_rows else None
 
+
+def _build_reaction_rows(post) -> list[list[InlineKeyboardButton]]:
+    """Ряды кнопок реакций с текущими счётчиками (недавно нажатые — из кэша итогов агрегатора)."""
+    if not getattr(post, 'reaction_buttons', None):
+        return []
+    reaction_rows_map: dict[int, list] = {}
+    for btn in post.reaction_buttons:
+        reaction_rows_map.setdefault(btn.row, []).append(btn)
+
+    rows = []
+    for row_idx in sorted(reaction_rows_map.keys()):
+        sorted_btns = sorted(reaction_rows_map[row_idx], key=lambda b: b.position)
+        reaction_row = []
+        for btn in sorted_btns:
+            count = REACTION_AGGREGATOR.count(btn.id, btn.click_count)
+            reaction_row.append(
+                InlineKeyboardButton(
+                    text=reaction_label(btn.emoji, count),
+                    callback_data=ReactionCD(button_id=btn.id).pack()
+                )
+            )
+        if reaction_row:
+            rows.append(reaction_row)
+    return rows
+
+
 async def check_auto_delete(bot: Bot):
     """
     Фоновая задача для автоудаления постов.
@@ -521,62 +904,10 @@ async def check_auto_delete(bot: Bot):
         # Ждём 30 секунд
         await asyncio.sleep(30)
 
-def _parse_entities(entities_json: str | None) -> list[MessageEntity] | None:
-    """Парсит JSON entities обратно в объекты MessageEntity."""
-    if not entities_json:
-        return None
-    try:
-        data = json.loads(entities_json)
-        return [MessageEntity(**e) for e in data]
-    except:
-        return None
-
-
-def _convert_to_html_with_emoji(text: str, entities_json: str | None) -> tuple[str, str | None]:
+def _convert_to_html_with_emoji(text: str, entities: list[dict] | str | None) -> tuple[str, str | None]:
     """
-    Конвертирует текст с entities в HTML с <tg-emoji> тегами.
+    Конвертирует текст с entities в HTML (все типы entities, включая <tg-emoji>).
     """
-    if not text or not entities_json:
-        return text, None
-
-    try:
-        entities = json.loads(entities_json)
-    except:
+    if not text:
         return text, None
-
-    # Фильтруем только custom_emoji
-    custom_emojis = [e for e in entities if e.get("type") == "custom_emoji"]
-
-    if not custom_emojis:
-        return text, None
-
-    # Сортируем по offset в обратном порядке
-    custom_emojis.sort(key=lambda e: e["offset"], reverse=True)
-
-    # Работаем с UTF-16 (Telegram использует UTF-16 для offset)
-    text_utf16 = text.encode('utf-16-le')
-
-    for e in custom_emojis:
-        offset = e["offset"]
-        length = e["length"]
-        emoji_id = e.get("custom_emoji_id")
-
-        if not emoji_id:
-            continue
-
-        # UTF-16 LE: 2 байта на code unit
-        start_bytes = offset * 2
-        end_bytes = (offset + length) * 2
-
-        # Извлекаем эмодзи
-        emoji_bytes = text_utf16[start_bytes:end_bytes]
-        original_emoji = emoji_bytes.decode('utf-16-le')
-
-        # HTML тег
-        html_tag = f'<tg-emoji emoji-id="{emoji_id}">{original_emoji}</tg-emoji>'.encode('utf-16-le')
-
-        # Заменяем в UTF-16
-        text_utf16 = text_utf16[:start_bytes] + html_tag + text_utf16[end_bytes:]
-
-    result = text_utf16.decode('utf-16-le')
-    return result, "HTML"
\ No newline at end of file
+    return entities_to_html(text, entities), "HTML"
@@ -0,0 +1,159 @@
+"""
+Кэш метаданных Telegram: getMe, getChat, getChatMember.
+
+Проверки прав бота и подписки пользователя вызываются на каждое нажатие кнопки и
+каждое подключение канала, а ответы меняются редко. Поэтому:
+- у каждого метода свой TTL (права бота в чате живут дольше, статус пользователя — меньше,
+  а «пользователь не в чате» — совсем недолго, чтобы подписка засчитывалась почти сразу);
+- ответы «чат не найден / нет доступа» (TelegramBadRequest, TelegramForbiddenError)
+  тоже кэшируются, на короткий срок, и повторно выбрасываются из кэша;
+- одновременные промахи по одному ключу ждут один запрос к API;
+- апдейт my_chat_member (бота добавили, сняли, поменяли права) сбрасывает всё
+  закэшированное по этому чату — см. handlers/bot_membership.py.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Union
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.types import ChatFullInfo, ChatMemberUnion, User
+
+from utils.ttl_cache import MISSING, TTLCache
+
+CHAT_TTL = 300.0
+BOT_MEMBER_TTL = 300.0
+USER_MEMBER_TTL = 30.0
+NOT_MEMBER_TTL = 5.0
+NEGATIVE_TTL = 30.0
+METADATA_MAXSIZE = 20_000
+
+# ошибки, которые являются ответом («нет такого чата / участника / доступа»), а не сбоем
+_NEGATIVE_ERRORS = (TelegramBadRequest, TelegramForbiddenError)
+_NOT_MEMBER_STATUSES = ("left", "kicked")
+
+# TTL записи: число или функция от загруженного значения (ответа или _Failure)
+_TTL = Union[float, Callable[[Any], float]]
+
+
+class _Failure:
+    __slots__ = ("error",)
+
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+
+class BotMetadataCache:
+    def __init__(
+            self,
+            *,
+            chat_ttl: float = CHAT_TTL,
+            bot_member_ttl: float = BOT_MEMBER_TTL,
+            user_member_ttl: float = USER_MEMBER_TTL,
+            not_member_ttl: float = NOT_MEMBER_TTL,
+            negative_ttl: float = NEGATIVE_TTL,
+            maxsize: int = METADATA_MAXSIZE,
+    ) -> None:
+        self.chat_ttl = chat_ttl
+        self.bot_member_ttl = bot_member_ttl
+        self.user_member_ttl = user_member_ttl
+        self.not_member_ttl = not_member_ttl
+        self.negative_ttl = negative_ttl
+        # (bot_id, chat_id | "@username") -> ChatFullInfo | _Failure
+        self.chats: TTLCache[tuple[int, int | str], Any] = TTLCache(maxsize=maxsize, ttl=chat_ttl)
+        # (bot_id, chat_id, user_id) -> ChatMember | _Failure
+        self.members: TTLCache[tuple[int, int, int], Any] = TTLCache(maxsize=maxsize, ttl=user_member_ttl)
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        # растёт при каждом сбросе: загрузка, начатая до сброса, не пишет результат в кэш
+        self._generation = 0
+
+    async def get_me(self, bot: Bot) -> User:
+        # Bot.me() сам хранит ответ getMe на всё время жизни бота
+        return await bot.me()
+
+    async def get_chat(self, bot: Bot, chat_id: int | str) -> ChatFullInfo:
+        return await self._cached(
+            self.chats,
+            (bot.id, chat_id),
+            self.chat_ttl,
+            lambda: bot.get_chat(chat_id=chat_id),
+        )
+
+    async def get_chat_member(self, bot: Bot, chat_id: int, user_id: int) -> ChatMemberUnion:
+        ttl = self.bot_member_ttl if user_id == bot.id else self._user_member_ttl
+        return await self._cached(
+            self.members,
+            (bot.id, chat_id, user_id),
+            ttl,
+            lambda: bot.get_chat_member(chat_id=chat_id, user_id=user_id),
+        )
+
+    async def get_bot_member(self, bot: Bot, chat_id: int) -> ChatMemberUnion:
+        """Статус и права самого бота в чате (id бота известен из токена, getMe не нужен)."""
+        return await self.get_chat_member(bot, chat_id, bot.id)
+
+    def _user_member_ttl(self, value: Any) -> float:
+        """Пользователя нет в чате (или Telegram его не знает) — ответ быстро устаревает."""
+        if isinstance(value, _Failure) or value.status in _NOT_MEMBER_STATUSES:
+            return self.not_member_ttl
+        if value.status == "restricted" and not value.is_member:
+            return self.not_member_ttl
+        return self.user_member_ttl
+
+    def invalidate_chat(self, chat_id: int) -> None:
+        """Сбрасывает getChat и все getChatMember по чату."""
+        self._generation += 1
+        self.chats.pop_where(lambda k, v: k[1] == chat_id or getattr(v, "id", None) == chat_id)
+        self.members.pop_where(lambda k, v: k[1] == chat_id)
+        for key in [k for k in self._inflight if k[1][1] == chat_id]:
+            self._inflight.pop(key, None)
+
+    def invalidate_member(self, chat_id: int, user_id: int) -> None:
+        self._generation += 1
+        self.members.pop_where(lambda k, v: k[1] == chat_id and k[2] == user_id)
+
+    async def _cached(
+            self,
+            cache: TTLCache,
+            key: tuple,
+            ttl: _TTL,
+            fetch: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        value = cache.get(key, MISSING)
+        if value is MISSING:
+            flight_key = (id(cache), key)
+            task = self._inflight.get(flight_key)
+            if task is None:
+                task = asyncio.ensure_future(self._load(cache, key, ttl, fetch))
+                self._inflight[flight_key] = task
+                task.add_done_callback(lambda t: self._load_done(flight_key, t))
+            # отмена одного ожидающего не должна отменять запрос остальным
+            value = await asyncio.shield(task)
+        if isinstance(value, _Failure):
+            raise value.error
+        return value
+
+    async def _load(self, cache: TTLCache, key: tuple, ttl: _TTL, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        generation = self._generation
+        try:
+            value = await fetch()
+        except _NEGATIVE_ERRORS as e:
+            value = _Failure(e)
+        if callable(ttl):
+            ttl = ttl(value)
+        elif isinstance(value, _Failure):
+            ttl = self.negative_ttl
+        if generation == self._generation:
+            cache.set(key, value, ttl)
+        return value
+
+    def _load_done(self, flight_key: Hashable, task: asyncio.Future) -> None:
+        if self._inflight.get(flight_key) is task:
+            del self._inflight[flight_key]
+        # сетевые ошибки не кэшируются; забираем их, если все ожидающие отменились
+        if not task.cancelled():
+            task.exception()
+
+
+BOT_METADATA = BotMetadataCache()
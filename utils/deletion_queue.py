@@ -0,0 +1,64 @@
+"""
+Очередь удаления сообщений в чатах обсуждения.
+
+comments_guard не удаляет комментарии сам: он кладёт message_id в очередь и сразу
+возвращается, а фоновая задача раз в flush_interval удаляет накопленное пачками
+через deleteMessages (до 100 id за вызов) — во время «налёта» на пост с выключенными
+комментариями это один запрос к API на сотню комментариев вместо сотни.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.3
+DELETE_MESSAGES_CHUNK = 100
+
+
+class MessageDeletionQueue:
+    def __init__(self, *, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.flush_interval = flush_interval
+        self._pending: dict[int, set[int]] = {}
+        self._bot: Bot | None = None
+        self._task: asyncio.Task | None = None
+
+    def enqueue(self, bot: Bot, chat_id: int, message_id: int) -> None:
+        self._bot = bot
+        self._pending.setdefault(chat_id, set()).add(message_id)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"[comments] deletion flush failed: {e}")
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        await asyncio.gather(*(self._flush_chat(chat_id, sorted(ids)) for chat_id, ids in pending.items()))
+
+    async def _flush_chat(self, chat_id: int, ids: list[int]) -> None:
+        for i in range(0, len(ids), DELETE_MESSAGES_CHUNK):
+            chunk = ids[i:i + DELETE_MESSAGES_CHUNK]
+            try:
+                await self._bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+            except TelegramRetryAfter:
+                # RateLimiter уже оштрафовал чат — отдадим остаток следующему сбросу
+                self._pending.setdefault(chat_id, set()).update(ids[i:])
+                return
+            except TelegramBadRequest as e:
+                # уже удалены / нет прав на удаление
+                logger.info(f"[comments] delete in chat={chat_id} failed: {e}")
+            except Exception as e:
+                logger.warning(f"[comments] delete in chat={chat_id} failed: {e}")
+
+
+COMMENT_DELETIONS = MessageDeletionQueue()
@@ -0,0 +1,168 @@
+"""
+Текст + Telegram entities -> HTML (parse_mode="HTML") за один проход.
+
+Offset/length у entities в UTF-16 code units, поэтому сначала все границы entities
+переводятся в индексы Python-строки (один проход по тексту), затем текст между
+соседними границами экранируется и выводится кусками, а теги открываются/закрываются
+по стеку. Пересекающиеся (не вложенные) entities корректно разрываются:
+внутренние теги закрываются и открываются заново.
+Сложность O(n + k·log n), без копирования текста на каждую entity.
+"""
+from __future__ import annotations
+
+import json
+import re
+from bisect import bisect_left
+from html import escape
+from typing import Any, Iterable
+
+_SIMPLE_TAGS = {
+    "bold": "b",
+    "italic": "i",
+    "underline": "u",
+    "strikethrough": "s",
+    "spoiler": "tg-spoiler",
+    "code": "code",
+    "blockquote": "blockquote",
+}
+
+
+# Символы вне BMP занимают в UTF-16 два code unit (суррогатная пара)
+_ASTRAL_RE = re.compile("[\U00010000-\U0010FFFF]")
+
+
+def _field(entity: Any, name: str) -> Any:
+    # dict (из JSON) или MessageEntity
+    if isinstance(entity, dict):
+        return entity.get(name)
+    return getattr(entity, name, None)
+
+
+def _tags(entity: Any) -> tuple[str, str] | None:
+    """(открывающий, закрывающий) тег entity; None — entity выводится как текст."""
+    etype = _field(entity, "type")
+    etype = getattr(etype, "value", etype)
+    if etype in _SIMPLE_TAGS:
+        tag = _SIMPLE_TAGS[etype]
+        return f"<{tag}>", f"</{tag}>"
+    if etype == "expandable_blockquote":
+        return "<blockquote expandable>", "</blockquote>"
+    if etype == "pre":
+        language = _field(entity, "language")
+        if language:
+            return f'<pre><code class="language-{escape(language)}">', "</code></pre>"
+        return "<pre>", "</pre>"
+    if etype == "text_link":
+        return f'<a href="{escape(_field(entity, "url") or "")}">', "</a>"
+    if etype == "text_mention":
+        user = _field(entity, "user")
+        user_id = _field(user, "id") if user is not None else None
+        if user_id is None:
+            return None
+        return f'<a href="tg://user?id={int(user_id)}">', "</a>"
+    if etype == "custom_emoji":
+        emoji_id = _field(entity, "custom_emoji_id")
+        if not emoji_id:
+            return None
+        return f'<tg-emoji emoji-id="{escape(str(emoji_id))}">', "</tg-emoji>"
+    # mention, hashtag, url и т.п. Telegram распознаёт в тексте сам
+    return None
+
+
+def dump_entities(entities: Iterable[Any] | None) -> list[dict] | None:
+    """MessageEntity -> компактные dict для Post.text_entities (JSONB), без None-полей."""
+    if not entities:
+        return None
+    return [e.model_dump(mode="json", exclude_none=True) for e in entities]
+
+
+def load_entities(entities: str | Iterable[Any] | None) -> list[Any]:
+    """
+    Entities из Post.text_entities как есть: список dict из JSONB читается без
+    пересборки MessageEntity; JSON-строка — старый формат колонки.
+    """
+    if not entities:
+        return []
+    if isinstance(entities, (str, bytes)):
+        try:
+            entities = json.loads(entities)
+        except ValueError:
+            return []
+    return list(entities)
+
+
+def _utf16_to_index(text: str, offsets: Iterable[int]) -> dict[int, int]:
+    """
+    UTF-16 offset -> индекс в str. Поиск символов вне BMP — один проход регэкспом (на C),
+    дальше каждый offset сдвигается на число суррогатных пар перед ним.
+    """
+    # UTF-16 offset, с которого начинается j-й символ вне BMP
+    astral_starts = [m.start() + j for j, m in enumerate(_ASTRAL_RE.finditer(text))]
+    size = len(text)
+    if not astral_starts:
+        return {o: min(o, size) for o in offsets}
+    return {o: min(o - bisect_left(astral_starts, o), size) for o in offsets}
+
+
+def entities_to_html(text: str, entities: str | Iterable[Any] | None) -> str:
+    """Экранированный HTML с тегами всех поддерживаемых entities (в т.ч. вложенных)."""
+    if not text:
+        return ""
+
+    spans: list[tuple[int, int, str, str]] = []
+    for e in load_entities(entities):
+        tags = _tags(e)
+        length = _field(e, "length") or 0
+        if tags is None or length <= 0:
+            continue
+        offset = _field(e, "offset") or 0
+        spans.append((offset, offset + length, tags[0], tags[1]))
+    if not spans:
+        return escape(text, quote=False)
+
+    index = _utf16_to_index(text, {p for s, e, _, _ in spans for p in (s, e)})
+    # внешние entities (начинаются раньше / заканчиваются позже) открываются первыми
+    spans = sorted(
+        ((index[s], index[e], open_tag, close_tag) for s, e, open_tag, close_tag in spans),
+        key=lambda x: (x[0], -x[1]),
+    )
+    boundaries = sorted({p for s, e, _, _ in spans for p in (s, e)})
+
+    out: list[str] = []
+    stack: list[tuple[int, int, str, str]] = []
+    open_ends: dict[int, int] = {}  # end -> сколько открытых entities на нём закончится
+    k = 0
+    prev = 0
+    for pos in boundaries:
+        if pos > prev:
+            out.append(escape(text[prev:pos], quote=False))
+            prev = pos
+
+        # закрываем всё, что кончается здесь; перекрывающие их теги откроем заново
+        if open_ends.get(pos):
+            reopen: list[tuple[int, int, str, str]] = []
+            while open_ends.get(pos):
+                span = stack.pop()
+                out.append(span[3])
+                if span[1] == pos:
+                    open_ends[pos] -= 1
+                else:
+                    reopen.append(span)
+            for span in reversed(reopen):
+                out.append(span[2])
+                stack.append(span)
+
+        while k < len(spans) and spans[k][0] == pos:
+            span = spans[k]
+            k += 1
+            if span[1] <= pos:
+                continue
+            out.append(span[2])
+            stack.append(span)
+            open_ends[span[1]] = open_ends.get(span[1], 0) + 1
+
+    if prev < len(text):
+        out.append(escape(text[prev:], quote=False))
+    while stack:
+        out.append(stack.pop()[3])
+    return "".join(out)
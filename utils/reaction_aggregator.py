@@ -0,0 +1,240 @@
+"""
+Write-behind агрегатор кнопок-реакций.
+
+Клик пользователя (строка reaction_clicks) записывается сразу, в обработчике, а
+изменения счётчиков копятся в памяти и раз в flush_interval уходят в БД одним upsert
+в слоты post_reaction_counter_shards (слот выбирается по user_id) — горячая строка
+популярной реакции не блокируется ни на каждое нажатие, ни между процессами.
+Раз в rollup_interval слоты сворачиваются в post_reaction_buttons.click_count.
+Счётчики для показа берутся из кэша итогов (click_count + слоты + ещё не записанное).
+
+Клавиатура сообщения в канале перерисовывается не на каждое нажатие: сообщение
+помечается «грязным» и редактируется не чаще раза в edit_interval, с последними
+счётчиками. Счётчики у поста общие, поэтому вместе с нажатым перерисовываются
+сообщения с клавиатурой (PostTarget.keyboard_message_id) во всех каналах поста.
+Текст меняется только у кнопок-реакций, остальные кнопки (URL, скрытое продолжение)
+берутся из клавиатуры нажатого сообщения как есть — у всех копий поста она одна.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from contextlib import suppress
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.engine import session_maker
+from database.orm_query import (
+    ReactionToggle,
+    orm_apply_reaction_deltas,
+    orm_get_post_keyboard_messages,
+    orm_rollup_reaction_shards,
+)
+from kbds.callbacks import ReactionCD
+from utils.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.5
+EDIT_INTERVAL = 3.0
+ROLLUP_INTERVAL = 10.0
+REACTION_COUNTER_SHARDS = 8
+# через столько итог кнопки перечитывается из БД при следующем нажатии
+TOTALS_TTL = 600.0
+TOTALS_MAXSIZE = 50_000
+# список сообщений с клавиатурой поста; новая публикация подхватится через столько
+KEYBOARDS_TTL = 60.0
+
+_REACTION_PREFIX = f"{ReactionCD.__prefix__}:"
+
+
+def reaction_label(emoji: str, count: int) -> str:
+    """Текст кнопки-реакции — как в клавиатуре, с которой пост был опубликован."""
+    return f"{emoji} {count}" if count > 0 else emoji
+
+
+class ReactionAggregator:
+    def __init__(
+            self,
+            session_pool: async_sessionmaker[AsyncSession],
+            *,
+            flush_interval: float = FLUSH_INTERVAL,
+            edit_interval: float = EDIT_INTERVAL,
+            rollup_interval: float = ROLLUP_INTERVAL,
+            shards: int = REACTION_COUNTER_SHARDS,
+    ) -> None:
+        self.session_pool = session_pool
+        self.flush_interval = flush_interval
+        self.edit_interval = edit_interval
+        self.rollup_interval = rollup_interval
+        self.shards = shards
+        # button_id -> (emoji, счётчик с учётом ещё не записанных изменений)
+        self._totals: TTLCache[int, tuple[str, int]] = TTLCache(maxsize=TOTALS_MAXSIZE, ttl=TOTALS_TTL)
+        # (button_id, shard) -> delta, ещё не отправленные в БД / отправляемые сейчас
+        self._pending: dict[tuple[int, int], int] = {}
+        self._flushing: dict[tuple[int, int], int] = {}
+        # в слотах есть несвёрнутые изменения
+        self._rollup_pending = False
+        self._rolled_up_at = time.monotonic()
+        # (chat_id, message_id) -> клавиатура сообщения, ждущего перерисовки
+        self._dirty: dict[tuple[int, int], InlineKeyboardMarkup] = {}
+        # post_id -> клавиатура нажатого сообщения, для перерисовки копий поста в других каналах
+        self._dirty_posts: dict[int, InlineKeyboardMarkup] = {}
+        self._keyboards: TTLCache[int, list[tuple[int, int]]] = TTLCache(maxsize=TOTALS_MAXSIZE, ttl=KEYBOARDS_TTL)
+        self._edited_at: TTLCache[tuple[int, int], float] = TTLCache(maxsize=TOTALS_MAXSIZE, ttl=edit_interval)
+        self._bot: Bot | None = None
+        self._task: asyncio.Task | None = None
+
+    def record(
+            self,
+            bot: Bot,
+            toggle: ReactionToggle,
+            *,
+            chat_id: int | None = None,
+            message_id: int | None = None,
+            markup: InlineKeyboardMarkup | None = None,
+    ) -> None:
+        """Учитывает нажатие (клик уже закоммичен) и помечает сообщение к перерисовке."""
+        self._bot = bot
+        for b in toggle.buttons:
+            if b.id not in self._totals:
+                # click_count из БД ещё не включает изменения, которые копятся здесь
+                self._totals.set(b.id, (b.emoji, b.click_count + self._unsaved(b.id)))
+        if toggle.delta:
+            emoji, count = self._totals.get(toggle.button_id)
+            self._totals.set(toggle.button_id, (emoji, max(0, count + toggle.delta)))
+            key = (toggle.button_id, toggle.user_id % self.shards)
+            self._pending[key] = self._pending.get(key, 0) + toggle.delta
+        if chat_id is not None and message_id is not None and markup is not None:
+            self._dirty[(chat_id, message_id)] = markup
+            if toggle.delta:
+                self._dirty_posts[toggle.post_id] = markup
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def count(self, button_id: int, default: int | None = None) -> int | None:
+        """Актуальный счётчик кнопки из кэша итогов; default — если кнопку давно не нажимали."""
+        total = self._totals.get(button_id)
+        return total[1] if total is not None else default
+
+    def _unsaved(self, button_id: int) -> int:
+        return sum(
+            self._pending.get((button_id, shard), 0) + self._flushing.get((button_id, shard), 0)
+            for shard in range(self.shards)
+        )
+
+    async def _run(self) -> None:
+        while self._pending or self._dirty or self._dirty_posts or self._rollup_pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_counts()
+                await self.flush_edits()
+                if self._rollup_pending and time.monotonic() - self._rolled_up_at >= self.rollup_interval:
+                    await self.rollup()
+            except Exception as e:
+                logger.exception(f"[reactions] flush failed: {e}")
+
+    async def flush_counts(self) -> None:
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, {}
+        try:
+            async with self.session_pool() as session:
+                await orm_apply_reaction_deltas(session, deltas=self._flushing)
+                await session.commit()
+            self._rollup_pending = True
+        except asyncio.CancelledError:
+            self._requeue()
+            raise
+        except Exception as e:
+            logger.warning(f"[reactions] counters flush failed, will retry: {e}")
+            self._requeue()
+        finally:
+            self._flushing = {}
+
+    def _requeue(self) -> None:
+        for key, delta in self._flushing.items():
+            self._pending[key] = self._pending.get(key, 0) + delta
+
+    async def rollup(self) -> None:
+        """Сворачивает слоты в click_count (итоги в кэше от этого не меняются)."""
+        self._rolled_up_at = time.monotonic()
+        async with self.session_pool() as session:
+            updated = await orm_rollup_reaction_shards(session)
+            await session.commit()
+        self._rollup_pending = False
+        logger.debug(f"[reactions] rolled up {updated} counters")
+
+    async def flush_edits(self) -> None:
+        dirty_posts, self._dirty_posts = self._dirty_posts, {}
+        for post_id, markup in dirty_posts.items():
+            for key in await self._keyboard_messages(post_id):
+                self._dirty.setdefault(key, markup)
+        due = [key for key in self._dirty if key not in self._edited_at]
+        await asyncio.gather(*(self._edit(key, self._dirty.pop(key)) for key in due))
+
+    async def _keyboard_messages(self, post_id: int) -> list[tuple[int, int]]:
+        keys = self._keyboards.get(post_id)
+        if keys is None:
+            try:
+                async with self.session_pool() as session:
+                    keys = await orm_get_post_keyboard_messages(session, post_id=post_id)
+            except Exception as e:
+                # нажатое сообщение уже в _dirty — перерисуется хотя бы оно
+                logger.warning(f"[reactions] keyboard messages of post {post_id} not loaded: {e}")
+                return []
+            self._keyboards.set(post_id, keys)
+        return keys
+
+    async def _edit(self, key: tuple[int, int], markup: InlineKeyboardMarkup) -> None:
+        new_markup = self._relabel(markup)
+        self._edited_at.set(key, time.monotonic())
+        if new_markup == markup:
+            return
+        chat_id, message_id = key
+        try:
+            await self._bot.edit_message_reply_markup(
+                chat_id=chat_id, message_id=message_id, reply_markup=new_markup,
+            )
+        except TelegramRetryAfter:
+            # RateLimiter уже оштрафовал чат — перерисуем на следующем проходе
+            self._dirty.setdefault(key, markup)
+        except TelegramBadRequest as e:
+            # сообщение удалено / не изменилось
+            logger.info(f"[reactions] edit {chat_id}/{message_id} failed: {e}")
+        except Exception as e:
+            logger.warning(f"[reactions] edit {chat_id}/{message_id} failed: {e}")
+
+    def _relabel(self, markup: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [self._relabel_button(btn) for btn in row] for row in markup.inline_keyboard
+        ])
+
+    def _relabel_button(self, btn: InlineKeyboardButton) -> InlineKeyboardButton:
+        if not btn.callback_data or not btn.callback_data.startswith(_REACTION_PREFIX):
+            return btn
+        try:
+            button_id = ReactionCD.unpack(btn.callback_data).button_id
+        except (TypeError, ValueError):
+            return btn
+        total = self._totals.get(button_id)
+        if total is None:
+            return btn
+        return btn.model_copy(update={"text": reaction_label(*total)})
+
+    async def close(self) -> None:
+        """Записывает накопленные счётчики и сворачивает слоты (при остановке бота)."""
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        await self.flush_counts()
+        if self._rollup_pending:
+            await self.rollup()
+
+
+REACTION_AGGREGATOR = ReactionAggregator(session_maker)